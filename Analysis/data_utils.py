@@ -1,13 +1,44 @@
 import os
+import sys
 import glob
 import json
-import gzip
-import pickle
+import numpy
 from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+# The trial data readers live with the server code that writes the data
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'HGym-Feedback', 'App'))
+import itertools
+from recording import open_recording, is_columnar, stream_steps, stream_stored_steps, project
+from replaycache import ReplayCache
 
 
 PlayStep = namedtuple('PlayStepData', ['action', 'obs', 'raw_obs', 'reward', 'done'])
 FeedbackStep = namedtuple('FeedbackStepData', ['feedback', 'done'])
+# Under their type names too, so steps can be pickled (e.g. by load_episodes)
+PlayStepData = PlayStep
+FeedbackStepData = FeedbackStep
+
+# The recorded fields each step field is read from, see iter_play_steps
+PLAY_FIELDS = {
+    'action': ('action',),
+    'obs': ('observation',),
+    'raw_obs': ('raw_observation', 'observation'),
+    'reward': ('reward',),
+    'done': ('done',)}
+FEEDBACK_FIELDS = {
+    'feedback': ('feedback',),
+    'done': ('done',)}
+OBSERVATION_FIELDS = frozenset(('observation', 'raw_observation'))
+
+# set_cache() caches decoded episodes here as uncompressed columnar
+# recordings that are memory-mapped. Off by default, it can use up to
+# CACHE_MB of disk
+CACHE_DIR = os.path.join('data', 'cache')
+CACHE_MB = 10240
+_cache_args = (None, CACHE_MB)
+_cache = None
 
 SURVEY_ONE_MAPPING = {
     'experience': 'ai_experience',
@@ -41,59 +72,80 @@ class Participant():
             self._parse_user_data()
         return self.user_data
 
-    def get_play_data(self, idx=None):
+    def get_play_data(self, idx=None, start=None, stop=None, workers=1):
+        '''
+        Returns the steps of play episode idx, or of every episode if idx is
+        None. start and stop select a range of steps, with the columnar
+        record format only that part of the file is read. Observations of
+        episodes recorded with actionRecording are regenerated by replaying
+        them, which needs the game's environment installed.
+        With workers other than 1 every episode is decoded in parallel, see
+        load_episodes.
+        '''
+        if idx is None and workers != 1:
+            return load_episodes(self.play_data_paths, load_play_steps, workers, False, start, stop)
         if idx is None:
             replay_data = []
             for i in range(len(self.play_data_paths)):
-                replay_data.append(self.get_play_data(i))
+                replay_data.append(self.get_play_data(i, start, stop))
             return replay_data
 
-        path = self.play_data_paths[idx]
-        # Unzip the file and load the pickled data
-        steps = []
-        with gzip.open(path, 'rb') as f:
-            while f.peek(1):
-                data = pickle.load(f)
-                steps.append(data)
-        if len(steps) == 1:
-            steps = steps[0]
-
-        transitions = []
-        for step in steps:
-            # Action may not be recorded in earlier versions
-            transitions.append(PlayStep(
-                step.get('action'),
-                step['observation'],
-                step.get('raw_observation', step['observation']),
-                step['reward'],
-                step['done']))
-
-        return transitions
-
-    def get_feedback_data(self, idx=None):
+        return load_play_steps(self.play_data_paths[idx], start, stop)
+
+    def iter_play_data(self, idx=None, fields=None, start=None, stop=None):
+        '''
+        Yields the PlaySteps of play episode idx, or of every episode one
+        after the other if idx is None, without loading whole episodes.
+        fields selects the PlayStep fields that are read, see
+        iter_play_steps.
+        '''
+        indices = range(len(self.play_data_paths)) if idx is None else [idx]
+        for i in indices:
+            yield from iter_play_steps(self.play_data_paths[i], fields, start, stop)
+
+    def iter_play_batches(self, batch_size, idx=None, fields=None):
+        '''
+        Yields the steps of play episode idx, or of every episode if idx is
+        None, in batches of batch_size, see iter_batches. A batch never
+        holds steps of two episodes.
+        '''
+        indices = range(len(self.play_data_paths)) if idx is None else [idx]
+        for i in indices:
+            yield from iter_batches(iter_play_steps(self.play_data_paths[i], fields), batch_size)
+
+    def get_feedback_data(self, idx=None, start=None, stop=None, workers=1):
+        '''
+        Returns the steps of feedback episode idx, or of every episode if idx
+        is None. start and stop select a range of steps, workers as in
+        get_play_data.
+        '''
+        if idx is None and workers != 1:
+            return load_episodes(self.feedback_data_paths, load_feedback_steps, workers, False, start, stop)
         if idx is None:
             feedback_data = []
             for i in range(len(self.feedback_data_paths)):
-                feedback_data.append(self.get_feedback_data(i))
+                feedback_data.append(self.get_feedback_data(i, start, stop))
             return feedback_data
 
-        path = self.feedback_data_paths[idx]
-        # Unzip the file and load the pickled data
-        steps = []
-        with gzip.open(path, 'rb') as f:
-            while f.peek(1):
-                data = pickle.load(f)
-                steps.append(data)
-        if len(steps) == 1:
-            steps = steps[0]
+        return load_feedback_steps(self.feedback_data_paths[idx], start, stop)
 
-        transitions = []
-        for step in steps:
-            # Action may not be recorded in earlier versions
-            transitions.append(FeedbackStep(
-                step['feedback'], step['done']))
+    def iter_feedback_data(self, idx=None, fields=None, start=None, stop=None):
+        '''
+        Yields the FeedbackSteps of feedback episode idx, or of every
+        episode, see iter_play_data.
+        '''
+        indices = range(len(self.feedback_data_paths)) if idx is None else [idx]
+        for i in indices:
+            yield from iter_feedback_steps(self.feedback_data_paths[i], fields, start, stop)
 
-        return transitions
+    def iter_feedback_batches(self, batch_size, idx=None, fields=None):
+        '''
+        Yields the steps of feedback episode idx, or of every episode, in
+        batches, see iter_play_batches.
+        '''
+        indices = range(len(self.feedback_data_paths)) if idx is None else [idx]
+        for i in indices:
+            yield from iter_batches(iter_feedback_steps(self.feedback_data_paths[i], fields), batch_size)
 
     def _parse_user_data(self):
         with open(self.user_data_path, 'r') as f:
@@ -119,6 +171,223 @@ class Participant():
             return '<Participant uid={}>'.format(self.uid)
         return '<Participant uid={} experiment_id={}>'.format(self.uid, self.experiment_id)
 
+def set_cache(directory=CACHE_DIR, maxMB=CACHE_MB):
+    '''
+    Turns on caching decoded episodes in directory, None turns the cache
+    off again. The cache is off until this is called.
+    The first time an episode is loaded it is decoded into an uncompressed
+    columnar recording in directory, after that it is memory-mapped from
+    there and only the steps used are read. Uncompressed observations take
+    a lot of disk, about 100KB per step of an Atari game, so set maxMB to
+    what the disk can spare. The cached copy is keyed by the
+    source's path, size and modification time, so a replaced source (e.g.
+    downloaded again) is decoded again. Least recently used episodes are
+    removed to keep the cache under maxMB. Episodes that are already
+    uncompressed columnar files are mapped where they are.
+    '''
+    global _cache, _cache_args
+    _cache_args = (directory, maxMB)
+    _cache = None
+
+def get_cache():
+    '''
+    Returns the ReplayCache set by set_cache, or None if it is off.
+    '''
+    global _cache
+    directory, maxMB = _cache_args
+    if directory is None:
+        return None
+    if _cache is None:
+        _cache = ReplayCache(directory, maxMB)
+    return _cache
+
+def open_episode(path):
+    '''
+    Returns a reader for the recording at path, through the cache if it is
+    on: reader[i] is step i, reader[start:stop] a list of steps.
+    Observations from a cached episode are read-only views of the cached
+    file, copy them before changing them.
+    '''
+    cache = get_cache()
+    if cache is None:
+        return open_recording(path)
+    return cache.open(path)
+
+def iter_recorded_steps(path, fields=None, start=None, stop=None):
+    '''
+    Yields the recorded steps (dicts) of the episode at path from start
+    up to stop, holding one chunk of a columnar recording or one step of a
+    pickle recording in memory at a time. fields, a frozenset of recorded
+    names, selects the fields read. Episodes are decoded into the cache
+    when observations are read, reads without them use a cached copy if
+    there is one and otherwise the source.
+    '''
+    decode = fields is None or bool(fields & OBSERVATION_FIELDS)
+    cache = get_cache()
+    reader = None
+    if cache is not None and decode:
+        reader = cache.open(path)
+    elif cache is not None:
+        cached = cache.find(path)
+        if cached is not None:
+            try:
+                reader = open_recording(cached)
+            except FileNotFoundError:
+                # Evicted in the meantime
+                pass
+    if reader is None and is_columnar(path):
+        reader = open_recording(path)
+    if reader is not None:
+        yield from reader.iter_steps(start, stop, fields)
+        return
+    # Compressed as a whole, the steps can only be read in order
+    steps = stream_steps(path) if decode else stream_stored_steps(path, fields)
+    for step in itertools.islice(steps, start, stop):
+        yield step if fields is None or not decode else project(step, fields)
+
+def recorded_fields(fields, mapping):
+    '''
+    Returns the recorded fields needed for the step fields in fields, or
+    None for all of them.
+    '''
+    if fields is None:
+        return None
+    unknown = set(fields) - set(mapping)
+    if unknown:
+        raise ValueError('Unknown fields {}, expected some of {}'.format(sorted(unknown), list(mapping)))
+    return frozenset(name for field in fields for name in mapping[field])
+
+def iter_play_steps(path, fields=None, start=None, stop=None):
+    '''
+    Yields the steps of the play episode recorded at path as PlaySteps,
+    decoding the columnar recording one chunk at a time. fields (e.g.
+    ('action', 'reward')) selects the PlayStep fields that are read, the
+    others are None. Without 'obs' and 'raw_obs' observations are never
+    decompressed, regenerated or decoded into the cache.
+    '''
+    recorded = recorded_fields(fields, PLAY_FIELDS)
+    for step in iter_recorded_steps(path, recorded, start, stop):
+        # Action may not be recorded in earlier versions
+        play_step = PlayStep(
+            step.get('action'),
+            step.get('observation'),
+            step.get('raw_observation', step.get('observation')),
+            step.get('reward'),
+            step.get('done'))
+        if fields is not None:
+            play_step = PlayStep(*(value if name in fields else None
+                                   for name, value in zip(PlayStep._fields, play_step)))
+        yield play_step
+
+def iter_feedback_steps(path, fields=None, start=None, stop=None):
+    '''
+    Yields the steps of the feedback episode recorded at path as
+    FeedbackSteps, see iter_play_steps.
+    '''
+    recorded = recorded_fields(fields, FEEDBACK_FIELDS)
+    for step in iter_recorded_steps(path, recorded, start, stop):
+        yield FeedbackStep(step.get('feedback'), step.get('done'))
+
+def iter_batches(steps, batch_size):
+    '''
+    Groups steps into batches of batch_size steps. A batch is a step of the
+    same type whose fields are numpy arrays stacked over the batch (None
+    for fields that were not read), the last batch may be smaller.
+    '''
+    batch = []
+    for step in steps:
+        batch.append(step)
+        if len(batch) == batch_size:
+            yield stack_steps(batch)
+            batch = []
+    if batch:
+        yield stack_steps(batch)
+
+def stack_steps(steps):
+    return type(steps[0])(*(None if all(value is None for value in values) else numpy.stack(values)
+                            for values in zip(*steps)))
+
+def iter_play_dataset(participants, fields=None):
+    '''
+    Yields (uid, PlayStep) for every play step of every participant, one
+    chunk of one episode in memory at a time, so statistics over a whole
+    experiment can be computed in constant memory. participants is the
+    dict returned by load_participant_data or a list of Participants.
+    '''
+    if isinstance(participants, dict):
+        participants = participants.values()
+    for participant in participants:
+        if participant.play_data_paths:
+            for step in participant.iter_play_data(fields=fields):
+                yield participant.uid, step
+
+def load_play_steps(path, start=None, stop=None):
+    '''
+    Returns the steps of the play episode recorded at path as PlaySteps.
+    '''
+    return list(iter_play_steps(path, start=start, stop=stop))
+
+def load_feedback_steps(path, start=None, stop=None):
+    '''
+    Returns the steps of the feedback episode recorded at path as
+    FeedbackSteps.
+    '''
+    return list(iter_feedback_steps(path, start=start, stop=stop))
+
+def load_episodes(paths, loader=load_play_steps, workers=None, progress=True, start=None, stop=None):
+    '''
+    Decodes the episodes at paths in a pool of worker processes (one per
+    cpu if workers is None) and returns their steps in the order of paths.
+    loader is load_play_steps or load_feedback_steps. progress prints how
+    many episodes are done, or can be a function called with (done, total).
+    The episodes' arrays are copied back from the workers, so once they are
+    in the cache (see set_cache) loading them in this process is faster,
+    the pool pays off for the first pass that decodes them.
+    '''
+    paths = list(paths)
+    load = partial(loader, start=start, stop=stop)
+    if progress is True:
+        progress = print_progress
+    episodes = []
+    # The workers use the same cache settings
+    with ProcessPoolExecutor(max_workers=workers, initializer=set_cache, initargs=_cache_args) as pool:
+        # map keeps the order of paths whatever order episodes finish in
+        for episode in pool.map(load, paths):
+            episodes.append(episode)
+            if progress:
+                progress(len(episodes), len(paths))
+    return episodes
+
+def print_progress(done, total):
+    print('\rLoaded {}/{} episodes'.format(done, total), end='\n' if done == total else '')
+
+def load_play_data(participants, workers=None, progress=True, start=None, stop=None):
+    '''
+    Loads the play episodes of every participant in parallel, see
+    load_episodes. Returns {uid: [episode, ...]} with each participant's
+    episodes in the same order as get_play_data.
+    '''
+    return _load_participant_episodes(participants, 'play_data_paths', load_play_steps,
+                                      workers, progress, start, stop)
+
+def load_feedback_data(participants, workers=None, progress=True, start=None, stop=None):
+    '''
+    Loads the feedback episodes of every participant in parallel, see
+    load_play_data.
+    '''
+    return _load_participant_episodes(participants, 'feedback_data_paths', load_feedback_steps,
+                                      workers, progress, start, stop)
+
+def _load_participant_episodes(participants, paths_attr, loader, workers, progress, start, stop):
+    if isinstance(participants, dict):
+        participants = participants.values()
+    participants = list(participants)
+    # One pool for all participants keeps every worker busy
+    paths = [getattr(p, paths_attr) or [] for p in participants]
+    episodes = iter(load_episodes([path for ps in paths for path in ps], loader,
+                                  workers, progress, start, stop))
+    return {p.uid: [next(episodes) for _ in ps] for p, ps in zip(participants, paths)}
+
 def load_participant_data(data_path='data/trials'):
     game_paths = glob.glob('{}/*'.format(data_path))
     participants = {}
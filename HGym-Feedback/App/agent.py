@@ -9,14 +9,21 @@ close()
 These functions are mandatory. This file contains minimum working versions 
 of these functions, adapt as required for individual research goals.
 '''
-import copy
-import pickle
-import gzip
+import inspect
 import gym
 from gym.wrappers import TimeLimit
 from nes_py.wrappers import JoypadSpace
 import gym_super_mario_bros
 from gym_super_mario_bros.actions import COMPLEX_MOVEMENT
+from recording import read_steps, stream_steps, ReadAhead
+
+def accepts_seed(env):
+    '''
+    Whether env.reset takes a seed (gym >= 0.22). Wrappers pass their
+    keyword arguments through to the environment they wrap, so the
+    environment at the bottom is the one checked.
+    '''
+    return 'seed' in inspect.signature(env.unwrapped.reset).parameters
 
 class Agent():
     '''
@@ -47,6 +54,7 @@ class Agent():
 
         if max_frames > 0:
             self.env = TimeLimit(self.env, max_episode_steps=max_frames)
+        self.env_state = {}
         return self.env
     
     def step(self, action:int):
@@ -60,17 +68,22 @@ class Agent():
         Returns:
             - envState (Type: dict containing all information to be recorded for future use)
               change contents of dict as desired, but return must be type dict.
+              Arrays are recorded without copying them (views of another
+              buffer are copied), if the env returns the same array object
+              every step copy it here.
         '''
         observation, reward, done, info = self.env.step(action)
+        # The Trial copies the values out right away, so one dict is reused
+        envState = self.env_state
         if self.render_obs:
-            rgb_observation = self.env.render('rgb_array')
-            envState = {
-                'observation': rgb_observation, 'raw_observation': observation,
-                'action': action, 'reward': reward, 'done': done, 'info': info}
+            envState['observation'] = self.env.render('rgb_array')
+            envState['raw_observation'] = observation
         else:
-            envState = {
-                'observation': observation, 'reward': reward,
-                'action': action, 'done': done, 'info': info}
+            envState['observation'] = observation
+        envState['action'] = action
+        envState['reward'] = reward
+        envState['done'] = done
+        envState['info'] = info
         return envState
     
     def render(self):
@@ -86,17 +99,27 @@ class Agent():
         '''
         return self.env.render('rgb_array')
     
-    def reset(self):
+    def reset(self, seed:int=None):
         '''
         Resets the environment to start new episode.
         Caller: 
             - Trial.reset()
         Inputs:
             - env (Type: OpenAI gym Environment)
+            - seed (Type: int, optional) given with 'actionRecording', the
+              episode must then only depend on the seed and the actions
+              taken so it can be regenerated, see regenerate.py
         Returns: 
             No Return
         '''
-        self.env.reset()
+        if seed is None:
+            self.env.reset()
+        elif accepts_seed(self.env):
+            self.env.reset(seed=seed)
+        else:
+            # Environments older than the gym seeding API
+            self.env.seed(seed)
+            self.env.reset()
     
     def close(self):
         '''
@@ -112,30 +135,68 @@ class Agent():
 
 
 def read_replay_buffer(path, trial_type):
-    step_data = []
-    with gzip.open(path, 'rb') as f:
-        while f.peek(1):
-            step_data.append(pickle.load(f))
-    if trial_type == 'trial':
-        step_data = step_data[0]
-    return step_data
+    '''
+    Reads every step of a recorded episode or trial, see recording.py for
+    the formats. Trial mode pickle files hold the whole trial as one list,
+    read_steps unpacks it.
+    '''
+    return read_steps(path)
 
 class ReplayAgent():
     '''
     Use this class as a convenient place to store agent state.
+    Replays are streamed: only a window of readAhead steps is held in
+    memory, and columnar recordings that are not compressed as a whole are
+    memory-mapped, so concurrent sessions replaying the same file share the
+    OS page cache instead of each holding a copy.
+    With a pre-encoded frame store (see framestore.py) the replay itself is
+    not read at all, encoded_render returns the stored frame of each step.
     '''
 
-    def start(self, replay_path:str, data_file_type:str='episode'):
+    def start(self, replay_path:str, data_file_type:str='episode', read_ahead:int=64, replay_cache=None,
+              frame_store=None):
         '''
         Starts an OpenAI gym environment.
         Caller:
             - Trial.start()
         Inputs:
             -   game (Type: str corresponding to allowable gym environments)
+            -   replay_cache (Type: replaycache.ReplayCache, optional) to
+                share one decoded copy of the replay between sessions
+            -   frame_store (Type: framestore.FrameStore, optional) with the
+                replay's pre-encoded frames
         '''
-        self.step_data = read_replay_buffer(replay_path, data_file_type)
+        self.frame_store = frame_store
         self.step_idx = 0
-        self.curr_obs = self.step_data[self.step_idx]['observation']
+        if frame_store is not None:
+            self.step_data = None
+            self.curr_step = {'done': frame_store.done(0)}
+            self.curr_obs = None
+            return
+        if replay_cache is not None:
+            steps = replay_cache.open(replay_path)
+        else:
+            steps = stream_steps(replay_path)
+        self.step_data = ReadAhead(steps, read_ahead)
+        self.curr_step = next(self.step_data)
+        self.curr_obs = self.curr_step['observation']
+
+    def next_step(self):
+        '''
+        Moves to the next recorded step. At the end of the replay the last
+        step is kept and reported as done.
+        '''
+        self.step_idx += 1
+        if self.frame_store is not None:
+            last = len(self.frame_store) - 1
+            self.curr_step = {'done': self.step_idx > last or self.frame_store.done(self.step_idx)}
+            return
+        step = next(self.step_data, None)
+        if step is None:
+            self.curr_step = dict(self.curr_step, done=True)
+        else:
+            self.curr_step = step
+        self.curr_obs = self.curr_step['observation']
     
     def step(self, action:int):
         '''
@@ -151,9 +212,8 @@ class ReplayAgent():
         '''
         # observation, reward, done, info = self.env.step(action)
         # envState = {'observation': observation, 'reward': reward, 'done': done, 'info': info}
-        self.step_idx += 1
-        self.curr_obs = self.step_data[self.step_idx]['observation']
-        return {'step': self.step_idx, 'done': self.step_data[self.step_idx]['done']}
+        self.next_step()
+        return {'step': self.step_idx, 'done': self.curr_step['done']}
     
     def render(self):
         '''
@@ -167,6 +227,15 @@ class ReplayAgent():
               must return the unchanged rgb_array
         '''
         return self.curr_obs
+
+    def encoded_render(self):
+        '''
+        Returns the current step's pre-encoded render dict from the frame
+        store, or None to have the Trial encode render() itself.
+        '''
+        if self.frame_store is None:
+            return None
+        return self.frame_store.render(min(self.step_idx, len(self.frame_store) - 1))
     
     def reset(self):
         '''
@@ -178,8 +247,7 @@ class ReplayAgent():
         Returns: 
             No Return
         '''
-        self.step_idx += 1
-        self.curr_obs = self.step_data[self.step_idx]['observation']
+        self.next_step()
         # self.env.reset()
     
     def close(self):
@@ -193,4 +261,5 @@ class ReplayAgent():
             No Return
         '''
         # self.env.close()
-        return
+        if self.step_data is not None:
+            self.step_data.close()
@@ -0,0 +1,319 @@
+'''
+Frame codecs used by Trial.get_render to turn an rgb_array into bytes
+that can be sent to the client.
+
+The codec is chosen with the optional 'frameCodec' entry of the trial config:
+
+    frameCodec:
+      type: jpeg    # jpeg, webp, png or raw
+      quality: 75   # jpeg and webp only
+      colors: 256   # png only, size of the quantized palette
+
+A plain string (e.g. frameCodec: png) selects the codec with its default
+options. Encoders are created once per Trial and reuse their output buffer
+for every frame, the input array is wrapped without copying when possible.
+
+Adding a 'frameDelta' entry lets clients that can draw delta frames ask
+for them by sending {"frameDelta": true}. The Trial then wraps the codec in
+a DeltaEncoder that only sends the tiles that changed since the previous
+frame, other clients keep getting full frames:
+
+    frameDelta:
+      tileSize: 16           # pixels, square tiles
+      keyframeInterval: 120  # frames between full keyframes
+      maxChangedRatio: 0.5   # send a keyframe if more tiles than this changed
+'''
+import time, math, logging
+import numpy
+from PIL import Image
+from io import BytesIO
+from protocol import CODEC_JPEG, CODEC_WEBP, CODEC_PNG, CODEC_RAW, \
+    FLAG_NONE, FLAG_DELTA, FLAG_KEYFRAME
+
+# Pillow >= 9.1 moved the quantize methods into an enum
+FAST_OCTREE = getattr(getattr(Image, 'Quantize', Image), 'FASTOCTREE', 2)
+
+
+class EncoderStats():
+    '''
+    Running totals of encode time and encoded size for one codec.
+    '''
+    def __init__(self, codec:str):
+        self.codec = codec
+        self.frames = 0
+        self.seconds = 0.0
+        self.bytes = 0
+
+    def add(self, seconds:float, size:int):
+        self.frames += 1
+        self.seconds += seconds
+        self.bytes += size
+
+    def report(self):
+        '''
+        Returns a dict summarizing the encoder's cost per frame.
+        '''
+        frames = max(self.frames, 1)
+        return {
+            'codec': self.codec,
+            'frames': self.frames,
+            'totalEncodeSeconds': round(self.seconds, 4),
+            'avgEncodeMs': round(1000 * self.seconds / frames, 3),
+            'totalBytes': self.bytes,
+            'avgBytes': self.bytes // frames}
+
+
+class FrameEncoder():
+    '''
+    Base class for frame encoders. Subclasses implement _encode, which
+    writes the encoded image for a PIL Image into self.buffer.
+    '''
+    name = None
+    codec_id = None
+
+    def __init__(self, **options):
+        self.options = options
+        self.buffer = BytesIO()
+        self.stats = EncoderStats(self.name)
+
+    def to_image(self, array):
+        '''
+        Wraps an HxWx3 uint8 array as a PIL Image. For contiguous arrays the
+        image shares the array's memory instead of copying it.
+        '''
+        array = numpy.ascontiguousarray(array, dtype=numpy.uint8)
+        height, width = array.shape[:2]
+        if array.ndim == 3 and array.shape[2] == 3:
+            return Image.frombuffer('RGB', (width, height), array, 'raw', 'RGB', 0, 1)
+        return Image.fromarray(array)
+
+    def encode(self, array):
+        '''
+        Encodes an rgb_array. Returns a tuple of (bytes, width, height).
+        '''
+        start = time.perf_counter()
+        height, width = array.shape[:2]
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        self._encode(array)
+        frame = self.buffer.getvalue()
+        self.stats.add(time.perf_counter() - start, len(frame))
+        return frame, width, height
+
+    def encode_render(self, array):
+        '''
+        Encodes an rgb_array into the render dict fields used by protocol.py.
+        '''
+        frame, width, height = self.encode(array)
+        return {'frame': frame, 'codec': self.codec_id, 'flags': FLAG_NONE,
+                'width': width, 'height': height}
+
+    def request_keyframe(self):
+        '''
+        Every frame is a full frame, nothing to do.
+        '''
+        return
+
+    def _encode(self, array):
+        raise NotImplementedError
+
+    def report(self):
+        return self.stats.report()
+
+
+class JpegEncoder(FrameEncoder):
+    name = 'jpeg'
+    codec_id = CODEC_JPEG
+
+    def _encode(self, array):
+        self.to_image(array).save(self.buffer, 'JPEG',
+            quality=self.options.get('quality', 75))
+
+
+class WebpEncoder(FrameEncoder):
+    name = 'webp'
+    codec_id = CODEC_WEBP
+
+    def _encode(self, array):
+        # method 0 is the fastest webp encoder setting
+        self.to_image(array).save(self.buffer, 'WEBP',
+            quality=self.options.get('quality', 75),
+            method=self.options.get('method', 0))
+
+
+class PngEncoder(FrameEncoder):
+    '''
+    Quantizes the frame to a palette before compressing. Atari games use far
+    fewer than 256 well separated colours so this is visually lossless for
+    them. The fast octree quantizer can merge nearly identical colours, set
+    colors to 0 to skip quantization.
+    '''
+    name = 'png'
+    codec_id = CODEC_PNG
+
+    def _encode(self, array):
+        img = self.to_image(array)
+        colors = self.options.get('colors', 256)
+        if colors:
+            img = img.quantize(colors=colors, method=FAST_OCTREE)
+        img.save(self.buffer, 'PNG',
+            compress_level=self.options.get('compressLevel', 1))
+
+
+class RawEncoder(FrameEncoder):
+    '''
+    Sends the uncompressed HxWx3 rgb bytes. Only sensible on fast links.
+    '''
+    name = 'raw'
+    codec_id = CODEC_RAW
+
+    def _encode(self, array):
+        self.buffer.write(numpy.ascontiguousarray(array, dtype=numpy.uint8).data)
+
+
+class DeltaEncoder():
+    '''
+    Wraps a FrameEncoder and sends only the square tiles that changed since
+    the previous frame. The changed tiles are packed into a single atlas
+    image so the wrapped codec is called once per frame. A full keyframe is
+    sent for the first frame, every keyframeInterval frames, when the client
+    asks for one (request_keyframe) and when so much of the screen changed
+    that a delta would not be smaller.
+    '''
+    def __init__(self, encoder:FrameEncoder, tileSize:int=16,
+                 keyframeInterval:int=120, maxChangedRatio:float=0.5):
+        self.encoder = encoder
+        self.name = encoder.name
+        self.codec_id = encoder.codec_id
+        self.tile_size = tileSize
+        self.keyframe_interval = keyframeInterval
+        self.max_changed_ratio = maxChangedRatio
+        self.previous = None
+        self.padded = None
+        self.frames_since_keyframe = 0
+        self.keyframe_requested = True
+        self.keyframes = 0
+        self.delta_frames = 0
+        self.tiles_sent = 0
+
+    def request_keyframe(self):
+        self.keyframe_requested = True
+
+    def _allocate(self, array):
+        '''
+        (Re)allocates the previous frame and the tile-aligned scratch frame
+        when the frame size changes.
+        '''
+        height, width = array.shape[:2]
+        ts = self.tile_size
+        self.rows = math.ceil(height / ts)
+        self.cols = math.ceil(width / ts)
+        self.previous = numpy.empty_like(array)
+        self.padded = numpy.zeros((self.rows * ts, self.cols * ts) + array.shape[2:], dtype=array.dtype)
+        self.keyframe_requested = True
+
+    def changed_tiles(self, array):
+        '''
+        Returns the flat indices (row * cols + col) of the tiles that differ
+        from the previous frame.
+        '''
+        height, width = array.shape[:2]
+        ts = self.tile_size
+        changed = array != self.previous
+        if changed.ndim == 3:
+            changed = changed.any(axis=2)
+        mask = numpy.zeros((self.rows * ts, self.cols * ts), dtype=bool)
+        mask[:height, :width] = changed
+        mask = mask.reshape(self.rows, ts, self.cols, ts).any(axis=(1, 3))
+        return numpy.flatnonzero(mask)
+
+    def build_atlas(self, array, tiles):
+        '''
+        Copies the given tiles out of the frame into a near-square grid.
+        '''
+        height, width = array.shape[:2]
+        ts = self.tile_size
+        self.padded[:height, :width] = array
+        grid = self.padded.reshape((self.rows, ts, self.cols, ts) + array.shape[2:])
+        columns = math.ceil(math.sqrt(len(tiles)))
+        atlas_rows = math.ceil(len(tiles) / columns)
+        atlas = numpy.zeros((atlas_rows, columns, ts, ts) + array.shape[2:], dtype=array.dtype)
+        rows, cols = numpy.divmod(tiles, self.cols)
+        atlas.reshape((-1, ts, ts) + array.shape[2:])[:len(tiles)] = grid[rows, :, cols]
+        atlas = atlas.swapaxes(1, 2).reshape((atlas_rows * ts, columns * ts) + array.shape[2:])
+        return atlas, columns
+
+    def encode_render(self, array):
+        array = numpy.ascontiguousarray(array)
+        if self.previous is None or self.previous.shape != array.shape:
+            self._allocate(array)
+
+        keyframe = self.keyframe_requested \
+            or self.frames_since_keyframe >= self.keyframe_interval
+        if not keyframe:
+            tiles = self.changed_tiles(array)
+            keyframe = len(tiles) > self.max_changed_ratio * self.rows * self.cols
+
+        height, width = array.shape[:2]
+        if keyframe:
+            render = self.encoder.encode_render(array)
+            render['flags'] = FLAG_KEYFRAME
+            self.keyframe_requested = False
+            self.frames_since_keyframe = 0
+            self.keyframes += 1
+        else:
+            if len(tiles):
+                atlas, columns = self.build_atlas(array, tiles)
+                frame = self.encoder.encode(atlas)[0]
+            else:
+                frame, columns = b'', 0
+            render = {'frame': frame, 'codec': self.codec_id, 'flags': FLAG_DELTA,
+                      'width': width, 'height': height, 'tileSize': self.tile_size,
+                      'columns': columns, 'tiles': tiles.tolist()}
+            self.frames_since_keyframe += 1
+            self.delta_frames += 1
+            self.tiles_sent += len(tiles)
+        numpy.copyto(self.previous, array)
+        return render
+
+    def report(self):
+        report = self.encoder.report()
+        report['keyframes'] = self.keyframes
+        report['deltaFrames'] = self.delta_frames
+        report['avgTilesPerDelta'] = round(self.tiles_sent / max(self.delta_frames, 1), 1)
+        return report
+
+
+ENCODERS = {cls.name: cls for cls in (JpegEncoder, WebpEncoder, PngEncoder, RawEncoder)}
+
+def parse_codec_config(codec_config=None):
+    '''
+    Returns the codec name and its options from the 'frameCodec' config
+    entry, which can be None (jpeg), the codec name, or a dict with a 'type'
+    and its options.
+    '''
+    if codec_config is None:
+        codec_config = {}
+    elif isinstance(codec_config, str):
+        codec_config = {'type': codec_config}
+    options = dict(codec_config)
+    codec = str(options.pop('type', 'jpeg')).strip().lower()
+    if codec not in ENCODERS:
+        raise ValueError(f'Unknown frameCodec type "{codec}", expected one of {list(ENCODERS)}')
+    return codec, options
+
+def make_encoder(codec_config=None, delta_config=None):
+    '''
+    Creates the encoder described by the 'frameCodec' config entry, see
+    parse_codec_config. If the 'frameDelta' entry is given the encoder sends
+    tile deltas.
+    '''
+    codec, options = parse_codec_config(codec_config)
+    logging.info(f'Using {codec} frame encoder with options {options}')
+    encoder = ENCODERS[codec](**options)
+    if delta_config:
+        if not isinstance(delta_config, dict):
+            delta_config = {}
+        logging.info(f'Using tile delta frames with options {delta_config}')
+        encoder = DeltaEncoder(encoder, **delta_config)
+    return encoder
@@ -2,7 +2,10 @@ import asyncio, websockets, json, os, sys, pathlib, ssl
 import json
 from trial import get_trial_type
 from multiprocessing import Process, Pipe
-from s3upload import Uploader
+from s3upload import UploadService
+from framering import FrameRing, ring_available
+from workers import WorkerPool, SessionHostPool
+from delivery import FrameDelivery
 import logging
 import yaml
 
@@ -10,9 +13,13 @@ TRIAL_COUNTER_FILE = 'trial_counter.json'
 ADDRESS = None # set desired IP for development 
 PORT = 5000 # if port is changed here it must also be changed in Dockerfile
 devEnv = False
+upload_service = None
 
 logging.basicConfig(filename='server.log', level=logging.INFO)
 
+# Put in a session's queue to wake its producer, see queue_producer_handler
+WAKEUP = object()
+
 
 def load_config():
     logging.info('Loading Config in communicator.py')
@@ -30,9 +37,18 @@ def main():
     global ADDRESS
     global PORT
     global devEnv
+    global upload_service
 
     config = load_config()
-    configured_handler = lambda w, p: handler(w, p, config)
+    pool = None
+    if config.get('sessionsPerWorker', 1) > 1:
+        # Sessions closed by the participant still upload their last file
+        pool = SessionHostPool(config.get('sessionsPerWorker'),
+                               lambda message: asyncio.ensure_future(upload_to_s3(message)))
+    elif config.get('workerPoolSize'):
+        pool = WorkerPool(config.get('workerPoolSize'))
+        pool.fill()
+    configured_handler = lambda w, p: handler(w, p, config, pool)
     init_trial_counter() # Initializes tracking for the current type of trial
     if len(sys.argv) > 1 and sys.argv[1] == 'dev':
         start_server = websockets.serve(configured_handler, ADDRESS, PORT)
@@ -41,9 +57,22 @@ def main():
         ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
         ssl_context.load_cert_chain('fullchain.pem', keyfile='privkey.pem')
         start_server = websockets.serve(configured_handler, None, PORT, ssl=ssl_context)
+        upload_service = create_upload_service(config)
     asyncio.get_event_loop().run_until_complete(start_server)
     asyncio.get_event_loop().run_forever()
 
+def create_upload_service(config):
+    '''
+    Starts the server's UploadService, which first resumes any uploads an
+    earlier server left in its spool.
+    '''
+    service_config = config.get('uploadService')
+    if not isinstance(service_config, dict):
+        service_config = {}
+    service = UploadService(**service_config)
+    service.start()
+    return service
+
 def init_trial_counter():
     with open(TRIAL_COUNTER_FILE, 'w+') as f:
         contents = {'total': 0}
@@ -86,86 +115,217 @@ def get_trial_counter(trial_type=None):
             return 0
     return data
     
-async def handler(websocket, path, config):
+async def handler(websocket, path, config, pool=None):
     '''
-    On websocket connection, starts a new userTrial in a new Process.
+    On websocket connection, starts a new userTrial in a new Process, or
+    hands it to a warm worker if a WorkerPool is configured, or opens it as
+    a session of a shared worker with a SessionHostPool.
     Then starts async listeners for sending and recieving messages.
     '''
     trial_counter = get_trial_counter('total')
-    upPipe, downPipe = Pipe()
     trial_type = config['trial_types'][trial_counter]
     trial_type_counter = get_trial_counter(trial_type)
     trial_cls = get_trial_type(trial_type)
     logging.info('------- STARTING TRIAL WITH TYPE: ' + trial_type + ' ' + str(trial_counter) + ' -------')
     update_trial_counter(trial_type)
-    userTrial = Process(target=trial_cls, args=(downPipe, trial_type_counter, trial_counter, config.get('dataFile', 'episode')))
-    userTrial.start()
-    consumerTask = asyncio.ensure_future(consumer_handler(websocket, upPipe))
-    producerTask = asyncio.ensure_future(producer_handler(websocket, upPipe))
-    done, pending = await asyncio.wait(
-        [consumerTask, producerTask],
-        return_when = asyncio.FIRST_COMPLETED
-    )
-    for task in pending:
-        task.cancel()
-    await websocket.close()
+    ring = create_frame_ring(config)
+    assignment = {
+        'trialType': trial_type,
+        'trialIdx': trial_type_counter,
+        'globalTrialIdx': trial_counter,
+        'dataFile': config.get('dataFile', 'episode'),
+        'frameRing': ring.spec() if ring else None}
+    host = None
+    if isinstance(pool, SessionHostPool):
+        host, upPipe, queue = pool.open(assignment)
+        delivery = create_frame_delivery(config, upPipe)
+        producer = queue_producer_handler(websocket, queue, ring, delivery, upPipe)
+    elif pool:
+        userTrial, upPipe = pool.acquire(assignment)
+        delivery = create_frame_delivery(config, upPipe)
+        producer = producer_handler(websocket, upPipe, ring, delivery)
+    else:
+        upPipe, downPipe = Pipe()
+        userTrial = Process(target=trial_cls, args=(downPipe, trial_type_counter, trial_counter, config.get('dataFile', 'episode')),
+                            kwargs={'frame_ring': ring.spec() if ring else None})
+        userTrial.start()
+        delivery = create_frame_delivery(config, upPipe)
+        producer = producer_handler(websocket, upPipe, ring, delivery)
+    try:
+        consumerTask = asyncio.ensure_future(consumer_handler(websocket, upPipe, delivery))
+        producerTask = asyncio.ensure_future(producer)
+        done, pending = await asyncio.wait(
+            [consumerTask, producerTask],
+            return_when = asyncio.FIRST_COMPLETED
+        )
+        for task in pending:
+            task.cancel()
+        await websocket.close()
+    finally:
+        if host:
+            host.close(upPipe.session_id)
+        if ring:
+            ring.close()
+            ring.unlink()
     return
 
-async def consumer_handler(websocket, pipe):
+def create_frame_delivery(config, pipe):
     '''
-    Listener that passes messages directly to userTrial process via Pipe
+    Creates the latest-frame-wins FrameDelivery for a session if
+    'frameDelivery' is configured, otherwise every frame is forwarded.
+    '''
+    delivery_config = config.get('frameDelivery')
+    if not delivery_config:
+        return None
+    if not isinstance(delivery_config, dict):
+        delivery_config = {}
+    return FrameDelivery(pipe, **delivery_config)
+
+def create_frame_ring(config):
+    '''
+    Creates the shared-memory frame ring for a session if 'frameRing' is
+    configured and supported by this Python version, otherwise frames are
+    sent through the pipe.
+    '''
+    ring_config = config.get('frameRing')
+    if not ring_config:
+        return None
+    if not ring_available():
+        logging.info('frameRing requires Python 3.8+, sending frames through the pipe.')
+        return None
+    if not isinstance(ring_config, dict):
+        ring_config = {}
+    return FrameRing.create(**ring_config)
+
+async def consumer_handler(websocket, pipe, delivery=None):
+    '''
+    Listener that passes messages directly to userTrial process via Pipe.
+    Frame acks are handled by the FrameDelivery and not passed on.
     '''
     async for message in websocket:
+        if delivery and delivery.handle_client_message(message):
+            continue
         pipe.send(message)
 
-async def producer_handler(websocket, pipe):
+async def producer_handler(websocket, pipe, ring=None, delivery=None):
+    '''
+    Forwards messages from the userTrial process to the websocket.
+    The pipe's file descriptor is registered with the event loop so this
+    coroutine only wakes up when the userTrial has actually sent something,
+    instead of polling. Each wakeup drains every message that is waiting.
+    With a FrameDelivery, client acks also wake it up to send the latest
+    frame.
+    '''
+    loop = asyncio.get_event_loop()
+    ready = asyncio.Event()
+    loop.add_reader(pipe.fileno(), ready.set)
+    if delivery:
+        delivery.wakeup = ready.set
+    try:
+        while True:
+            await ready.wait()
+            ready.clear()
+            while pipe.poll():
+                if await producer(websocket, pipe, ring, delivery):
+                    return
+            await deliver_frame(websocket, ring, delivery)
+    finally:
+        loop.remove_reader(pipe.fileno())
+
+async def queue_producer_handler(websocket, queue, ring=None, delivery=None, trial_pipe=None):
     '''
-    Loop to call producer for messages to send from userTrial process.
-    Note that asyncio.sleep() is required to make this non-blocking
-    default sleep time is (0.01) which creates a maximum framerate of 
-    just under 100 frames/s. For faster framerates decrease sleep time
-    however be aware that this will affect the ability of the
-    consumer_handler function to keep up with messages from the websocket
-    and may cause poor performance if the web-client is sending a high volume
-    of messages.
+    Forwards the messages a SessionHost routed to this session's queue.
+    A None in the queue means the host process went away. trial_pipe sends
+    messages back to the session.
     '''
-    done = False
+    if delivery:
+        delivery.wakeup = lambda: queue.put_nowait(WAKEUP)
     while True:
-        done = await producer(websocket, pipe)
-        await asyncio.sleep(0.01)
-    return
+        message = await queue.get()
+        while True:
+            if message is None:
+                return
+            if message is not WAKEUP and await forward_message(websocket, message, ring, delivery, trial_pipe):
+                return
+            if queue.empty():
+                break
+            message = queue.get_nowait()
+        await deliver_frame(websocket, ring, delivery)
 
-async def producer(websocket, pipe):
+async def producer(websocket, pipe, ring=None, delivery=None):
     '''
     Check userTrial process pipe for messages to send to websocket.
-    If userTrial is done, send final message to websocket and return
-    True to tell calling functions that userTrial is complete.
+    Returns True to tell calling functions that userTrial is complete.
+    If the userTrial process exited without saying it was done the pipe is
+    closed, which also ends the session.
     '''
     if pipe.poll():
-        message = pipe.recv()
-        if message == 'done':
-            await websocket.send('done')
+        try:
+            message = pipe.recv()
+        except EOFError:
+            logging.info('userTrial pipe closed.')
             return True
-        elif 'upload' in message:
-            await upload_to_s3(message)
-        else:
-            await websocket.send(message)
+        return await forward_message(websocket, message, ring, delivery, pipe)
+    return False
+
+async def forward_message(websocket, message, ring=None, delivery=None, trial_pipe=None):
+    '''
+    Handles one message from a userTrial.
+    If userTrial is done, send final message to websocket and return
+    True to tell calling functions that userTrial is complete.
+    Frames arrive as {'frameId', 'delta', 'frame' or 'frameSlot'} and are
+    sent right away, or handed to the FrameDelivery which decides when.
+    '''
+    if message == 'done':
+        await websocket.send('done')
+        return True
+    elif isinstance(message, dict) and 'frameId' in message:
+        if delivery:
+            delivery.offer(message)
+        elif not await send_frame(websocket, message, ring) and trial_pipe is not None:
+            # The frame was overwritten in the ring before it was read, in a
+            # delta stream the client's image is stale until a keyframe
+            trial_pipe.send(json.dumps({'command': 'keyframe'}))
+    elif isinstance(message, dict) and 'upload' in message:
+        await upload_to_s3(message)
+    else:
+        await websocket.send(message)
     return False
 
+async def send_frame(websocket, frame, ring=None):
+    '''
+    Sends a frame message to the websocket. Frames sent with the binary
+    protocol are bytes and go out as binary websocket messages, json frames
+    as text. Frames in the shared-memory ring are read from their slot,
+    frames already overwritten are skipped. Returns whether it was sent.
+    '''
+    if 'frameSlot' in frame:
+        message = ring.read(frame['frameSlot'])
+        if message is None:
+            return False
+    else:
+        message = frame['frame']
+    await websocket.send(message)
+    return True
+
+async def deliver_frame(websocket, ring=None, delivery=None):
+    '''
+    Sends the frame the FrameDelivery has ready, if any.
+    '''
+    if not delivery:
+        return
+    frame = delivery.take()
+    if frame is not None and not await send_frame(websocket, frame, ring):
+        delivery.drop(frame)
+    delivery.report()
+
 async def upload_to_s3(message):
     global devEnv
     logging.info(devEnv)
     if devEnv:
         logging.info('Dev set... Not uploading to s3.')
         return
-    file = message['upload']['file']
-    path = message['upload']['path']
-    projectId = message['upload']['projectId']
-    userId = message['upload']['userId']
-    bucket =  message['upload']['bucket']
-    compress = message['upload']['gzip']
-    logging.info(f'Starting upload of {file} to s3...')
-    Process(target=Uploader, args=(projectId, userId, file, path, bucket, compress)).start()
+    upload_service.submit(message['upload'])
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,139 @@
+'''
+Latest-frame-wins delivery of frames from a Trial to a slow participant.
+
+Without it every frame the Trial produces is forwarded in order, so on a
+slow connection frames pile up and the participant sees the game seconds
+late. FrameDelivery sits between the Trial's messages and the websocket in
+the communicator and holds at most one frame waiting to be sent: a newer
+frame replaces it and the older one is dropped.
+
+Clients that acknowledge frames by sending {"ackFrameId": <frameId>} also
+limit how many frames can be unacknowledged at once (maxFramesInFlight),
+so frames are only sent as fast as the client actually receives them.
+Clients that never ack only get the coalescing of frames that were waiting
+at the same time. Frames unacknowledged for ackTimeout seconds are assumed
+lost so a client that stops acking does not stall the stream.
+
+Dropping a delta frame (see codec.DeltaEncoder) would corrupt the client's
+image, so after a drop delta frames are skipped until a keyframe arrives
+and one is requested from the Trial with the 'keyframe' command.
+
+About every reportInterval seconds the Trial is sent
+{'deliveryReport': {'deliveredFrameRate', 'droppedFrames'}} where
+droppedFrames lists the frameIds that never reached the participant. The
+Trial records it with the next step and logs a summary of the delivered
+frame rate when it ends (Trial.delivery_report), the dropped steps
+themselves are recorded as usual.
+
+Enabled with the optional 'frameDelivery' trial config entry:
+
+    frameDelivery:
+      maxFramesInFlight: 2
+      ackTimeout: 1.0
+      reportInterval: 1.0
+'''
+import json, time
+from collections import deque
+
+
+class FrameDelivery():
+    def __init__(self, trial_pipe, maxFramesInFlight:int=2, ackTimeout:float=1.0, reportInterval:float=1.0):
+        self.trial_pipe = trial_pipe
+        self.max_in_flight = maxFramesInFlight
+        self.ack_timeout = ackTimeout
+        self.report_interval = reportInterval
+        self.pending = None
+        self.in_flight = deque()
+        self.acking = False
+        self.delta_stream = False
+        self.waiting_for_keyframe = False
+        self.dropped = []
+        self.delivered = 0
+        self.last_report = time.monotonic()
+        self.wakeup = None
+
+    def offer(self, frame:dict):
+        '''
+        Queues a frame message from the Trial ({'frameId', 'delta', ...}),
+        replacing and dropping the frame already waiting, if any.
+        '''
+        if frame.get('delta'):
+            self.delta_stream = True
+        if self.pending is not None:
+            self.pending, dropped = None, self.pending
+            self.drop(dropped)
+        if not frame.get('delta'):
+            self.waiting_for_keyframe = False
+        elif self.waiting_for_keyframe:
+            self.drop(frame)
+            return
+        self.pending = frame
+
+    def drop(self, frame:dict):
+        '''
+        Records a frame that will never be sent. In a delta stream the
+        client's image is now stale, so ask the Trial for a keyframe.
+        '''
+        self.dropped.append(frame['frameId'])
+        if self.delta_stream and not self.waiting_for_keyframe:
+            self.waiting_for_keyframe = True
+            self.trial_pipe.send(json.dumps({'command': 'keyframe'}))
+
+    def take(self):
+        '''
+        Returns the frame to send now, or None if there is nothing to send or
+        the client has too many frames unacknowledged.
+        '''
+        if self.pending is None:
+            return None
+        now = time.monotonic()
+        while self.in_flight and now - self.in_flight[0][1] > self.ack_timeout:
+            self.in_flight.popleft()
+        if self.acking and len(self.in_flight) >= self.max_in_flight:
+            return None
+        frame, self.pending = self.pending, None
+        if self.acking:
+            self.in_flight.append((frame['frameId'], now))
+        else:
+            self.delivered += 1
+        return frame
+
+    def ack(self, frameId:int):
+        '''
+        Handles an ack from the client for frameId and every frame before it.
+        '''
+        self.acking = True
+        while self.in_flight and self.in_flight[0][0] <= frameId:
+            self.in_flight.popleft()
+            self.delivered += 1
+        if self.wakeup is not None:
+            self.wakeup()
+
+    def handle_client_message(self, message):
+        '''
+        Consumes ack messages from the client. Returns True if the message
+        was only an ack and does not need to be passed on to the Trial.
+        '''
+        if not isinstance(message, str) or 'ackFrameId' not in message:
+            return False
+        try:
+            parsed = json.loads(message)
+            self.ack(int(parsed['ackFrameId']))
+        except (ValueError, TypeError, KeyError):
+            return False
+        return len(parsed) == 1
+
+    def report(self):
+        '''
+        Sends the Trial a delivery report if reportInterval has passed.
+        '''
+        now = time.monotonic()
+        elapsed = now - self.last_report
+        if elapsed < self.report_interval:
+            return
+        self.trial_pipe.send(json.dumps({'deliveryReport': {
+            'deliveredFrameRate': round(self.delivered / elapsed, 2),
+            'droppedFrames': self.dropped}}))
+        self.delivered = 0
+        self.dropped = []
+        self.last_report = now
@@ -0,0 +1,122 @@
+'''
+Shared-memory ring buffer used to pass encoded frames from a Trial process
+to the websocket server without pickling them through the Pipe.
+
+The communicator creates one ring per session and the Trial attaches to it
+by name. The Trial writes each frame message into the next slot and sends
+only {'frameSlot': seq} through the pipe, the communicator then reads the
+slot back. The writer never waits for the reader: when the reader falls
+behind, the oldest slots are overwritten and reading them returns None.
+
+Each slot starts with SLOT_HEADER (sequence number, payload length, kind)
+followed by up to slotSize payload bytes. The sequence number is cleared
+while a slot is written and checked again after it is read, so a frame
+overwritten during the read is detected and dropped.
+
+Enabled with the optional 'frameRing' trial config entry:
+
+    frameRing:
+      slots: 8            # frames held in the ring
+      slotSize: 262144    # max bytes per frame, larger frames use the pipe
+
+Requires Python 3.8+ (multiprocessing.shared_memory), on older versions
+frames are sent through the pipe as before.
+'''
+import struct
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+SLOT_HEADER = struct.Struct('<QIB')
+KIND_TEXT = 0
+KIND_BINARY = 1
+
+
+def ring_available():
+    return shared_memory is not None
+
+
+class FrameRing():
+    def __init__(self, shm, slots:int, slot_size:int, owner:bool=False):
+        self.shm = shm
+        self.name = shm.name
+        self.slots = slots
+        self.slot_size = slot_size
+        self.stride = SLOT_HEADER.size + slot_size
+        self.owner = owner
+        self.seq = 0
+
+    @classmethod
+    def create(cls, slots:int=8, slotSize:int=262144):
+        '''
+        Creates a new ring, the caller owns it and must unlink it when the
+        session ends.
+        '''
+        shm = shared_memory.SharedMemory(create=True, size=slots * (SLOT_HEADER.size + slotSize))
+        shm.buf[:] = bytes(shm.size)
+        return cls(shm, slots, slotSize, owner=True)
+
+    @classmethod
+    def attach(cls, spec:dict):
+        '''
+        Attaches to a ring created by the communicator from its spec(). Trial
+        processes are forked from the communicator and share its resource
+        tracker, so attaching does not take over ownership of the ring.
+        '''
+        shm = shared_memory.SharedMemory(name=spec['name'])
+        return cls(shm, spec['slots'], spec['slotSize'])
+
+    def spec(self):
+        '''
+        Everything another process needs to attach to this ring.
+        '''
+        return {'name': self.name, 'slots': self.slots, 'slotSize': self.slot_size}
+
+    def write(self, message):
+        '''
+        Writes a frame message (str or bytes) into the next slot, overwriting
+        the oldest frame. Returns its sequence number, or None if the message
+        does not fit in a slot.
+        '''
+        if isinstance(message, str):
+            message = message.encode('utf-8')
+            kind = KIND_TEXT
+        else:
+            kind = KIND_BINARY
+        size = len(message)
+        if size > self.slot_size:
+            return None
+        self.seq += 1
+        offset = (self.seq % self.slots) * self.stride
+        buf = self.shm.buf
+        SLOT_HEADER.pack_into(buf, offset, 0, size, kind)
+        start = offset + SLOT_HEADER.size
+        buf[start:start + size] = message
+        SLOT_HEADER.pack_into(buf, offset, self.seq, size, kind)
+        return self.seq
+
+    def read(self, seq:int):
+        '''
+        Returns the frame message written with sequence number seq, or None if
+        it has been overwritten since.
+        '''
+        offset = (seq % self.slots) * self.stride
+        buf = self.shm.buf
+        slot_seq, size, kind = SLOT_HEADER.unpack_from(buf, offset)
+        if slot_seq != seq:
+            return None
+        start = offset + SLOT_HEADER.size
+        message = bytes(buf[start:start + size])
+        if SLOT_HEADER.unpack_from(buf, offset)[0] != seq:
+            return None
+        if kind == KIND_TEXT:
+            return message.decode('utf-8')
+        return message
+
+    def close(self):
+        self.shm.close()
+
+    def unlink(self):
+        if self.owner:
+            self.shm.unlink()
@@ -0,0 +1,182 @@
+'''
+Pre-encoded replay frames for feedback trials.
+
+A feedback trial shows every participant the same recorded replay, and
+would otherwise encode each of its observations again with the frame codec
+for every participant. updateProject.prepare_replay_files instead encodes
+each replay once, with the trial config's frameCodec, into a frame store
+next to it (replay_data_{idx}.frames). ReplayAgent then plays the replay
+from the frame store alone: the encoded bytes of a step are sliced out of
+a memory-mapped file and sent as they are, nothing is decoded or encoded.
+
+File layout:
+
+    MAGIC
+    encoded frames, one after another
+    offsets: steps + 1 little endian uint64, frame i is [offsets[i], offsets[i+1])
+    header:  json {'version', 'codec', 'options', 'codecId', 'width',
+             'height', 'steps', 'done': [step, ...], 'source': {'size', 'digest'}}
+    FOOTER  (offsets position, header length, MAGIC)
+
+Frames are full frames, frameDelta does not apply to them. A frame store
+is only used if it was built with the frameCodec currently configured and
+from the replay file that is there now, otherwise the replay is played
+and encoded as before.
+'''
+import hashlib, json, logging, mmap, os, struct, time
+from codec import make_encoder, parse_codec_config
+from protocol import FLAG_NONE
+from recording import EXTENSIONS, stream_steps
+
+MAGIC = b'HGFRM1'
+OFFSET = struct.Struct('<Q')
+FOOTER = struct.Struct('<QQ6s')
+VERSION = 1
+EXTENSION = '.frames'
+SAMPLE_BYTES = 2**16
+
+
+def frame_store_path(replay_path:str):
+    '''
+    Path of the frame store for the replay at replay_path, which does not
+    depend on the replay's compression.
+    '''
+    for extension in EXTENSIONS.values():
+        if extension and replay_path.endswith(extension):
+            replay_path = replay_path[:-len(extension)]
+            break
+    return replay_path + EXTENSION
+
+def source_info(replay_path:str):
+    '''
+    Identifies the replay a frame store was built from by its size and a
+    digest of its first and last SAMPLE_BYTES, which unlike the modification
+    time survive copying the replay into the Docker image.
+    '''
+    size = os.path.getsize(replay_path)
+    digest = hashlib.sha1()
+    with open(replay_path, 'rb') as infile:
+        digest.update(infile.read(SAMPLE_BYTES))
+        infile.seek(max(size - SAMPLE_BYTES, 0))
+        digest.update(infile.read(SAMPLE_BYTES))
+    return {'size': size, 'digest': digest.hexdigest()}
+
+def build_frame_store(replay_path:str, codec_config=None, path:str=None):
+    '''
+    Encodes every observation of the replay at replay_path with the
+    'frameCodec' config entry codec_config and writes them to a frame store
+    at path (frame_store_path by default). Returns the path.
+    '''
+    if path is None:
+        path = frame_store_path(replay_path)
+    start = time.monotonic()
+    codec, options = parse_codec_config(codec_config)
+    encoder = make_encoder(codec_config)
+    offsets = []
+    done = []
+    size = None
+    pending = path + '.tmp'
+    with open(pending, 'wb') as outfile:
+        outfile.write(MAGIC)
+        position = len(MAGIC)
+        for idx, step in enumerate(stream_steps(replay_path)):
+            frame, width, height = encoder.encode(step['observation'])
+            if size is None:
+                size = (width, height)
+            elif size != (width, height):
+                raise ValueError(f'Replay {replay_path} changes frame size at step {idx}')
+            if step.get('done'):
+                done.append(idx)
+            offsets.append(position)
+            outfile.write(frame)
+            position += len(frame)
+        offsets.append(position)
+        width, height = size or (0, 0)
+        header = json.dumps({
+            'version': VERSION,
+            'codec': codec,
+            'options': options,
+            'codecId': encoder.codec_id,
+            'width': width,
+            'height': height,
+            'steps': len(offsets) - 1,
+            'done': done,
+            'source': source_info(replay_path)}).encode('utf-8')
+        outfile.write(b''.join(OFFSET.pack(offset) for offset in offsets))
+        outfile.write(header)
+        outfile.write(FOOTER.pack(position, len(header), MAGIC))
+    os.replace(pending, path)
+    logging.info(f'Built frame store {path} ({len(offsets) - 1} {codec} frames, '
+                 + f'{position} bytes) in {time.monotonic() - start:.2f}s')
+    return path
+
+
+class FrameStore():
+    '''
+    Reads a frame store through a read-only memory map, so the processes
+    playing the same replay share it in the OS page cache.
+    '''
+    def __init__(self, path:str):
+        self.path = path
+        with open(path, 'rb') as infile:
+            self.buffer = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.buffer) < len(MAGIC) + FOOTER.size or self.buffer[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{path} is not a frame store')
+        self.offsets_at, header_length, magic = FOOTER.unpack_from(self.buffer, len(self.buffer) - FOOTER.size)
+        if magic != MAGIC:
+            raise ValueError(f'Frame store {path} is incomplete')
+        header_at = len(self.buffer) - FOOTER.size - header_length
+        self.header = json.loads(bytes(self.buffer[header_at:header_at + header_length]).decode('utf-8'))
+        self.steps = self.header['steps']
+        self.done_steps = set(self.header['done'])
+
+    def __len__(self):
+        return self.steps
+
+    def frame(self, idx:int):
+        '''
+        Returns the encoded bytes of step idx.
+        '''
+        start, end = struct.unpack_from('<QQ', self.buffer, self.offsets_at + OFFSET.size * idx)
+        return self.buffer[start:end]
+
+    def done(self, idx:int):
+        return idx in self.done_steps
+
+    def render(self, idx:int):
+        '''
+        Returns step idx as the render dict fields produced by
+        FrameEncoder.encode_render.
+        '''
+        return {'frame': self.frame(idx), 'codec': self.header['codecId'], 'flags': FLAG_NONE,
+                'width': self.header['width'], 'height': self.header['height']}
+
+    def matches(self, replay_path:str, codec_config=None):
+        '''
+        Whether the store holds the replay at replay_path encoded with the
+        'frameCodec' config entry codec_config.
+        '''
+        codec, options = parse_codec_config(codec_config)
+        return (self.header.get('version') == VERSION
+                and self.header['codec'] == codec
+                and self.header['options'] == options
+                and self.header['source'] == source_info(replay_path))
+
+
+def open_frame_store(replay_path:str, codec_config=None):
+    '''
+    Returns the FrameStore for the replay at replay_path if there is one
+    that is up to date for codec_config, otherwise None.
+    '''
+    path = frame_store_path(replay_path)
+    if not os.path.exists(path):
+        return None
+    try:
+        store = FrameStore(path)
+    except ValueError as e:
+        logging.info(f'Ignoring frame store: {e}')
+        return None
+    if not store.matches(replay_path, codec_config):
+        logging.info(f'Ignoring frame store {path}, it was built for another replay or frameCodec')
+        return None
+    return store
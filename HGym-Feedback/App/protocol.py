@@ -0,0 +1,118 @@
+'''
+Wire format for frames sent from a Trial to the web client.
+
+Two protocols are supported and chosen per connection:
+    - json:   {"frame": <base64 string>, "frameId": <int>} text messages.
+              This is the original protocol and is kept for older clients.
+    - binary: a binary websocket message made of a small fixed header
+              followed by the raw encoded image bytes.
+
+Binary header layout (little endian, FRAME_HEADER.size bytes):
+    uint32  frameId
+    uint8   codec    (one of the CODEC_* ids below)
+    uint8   flags    (bit field, see FLAG_* below)
+    uint16  width
+    uint16  height
+
+Delta frames (FLAG_DELTA set, see codec.DeltaEncoder) follow the header with
+    uint16  tileSize
+    uint16  columns  (tiles per row of the atlas image)
+    uint16  count    (number of changed tiles)
+    uint16  tiles[count]  (index of each tile, row * ceil(width / tileSize) + col)
+and then the encoded atlas: the changed tiles laid out left to right, top to
+bottom, `columns` tiles per row. Keyframes (FLAG_KEYFRAME) carry the full
+frame. A delta frame with count == 0 means nothing changed.
+'''
+import struct, base64, json
+
+PROTOCOL_JSON = 'json'
+PROTOCOL_BINARY = 'binary'
+PROTOCOLS = (PROTOCOL_JSON, PROTOCOL_BINARY)
+
+CODEC_JPEG = 1
+CODEC_WEBP = 2
+CODEC_PNG = 3
+CODEC_RAW = 4 # uncompressed rgb, width * height * 3 bytes
+
+CODEC_MIME_TYPES = {
+    CODEC_JPEG: 'image/jpeg',
+    CODEC_WEBP: 'image/webp',
+    CODEC_PNG: 'image/png',
+    CODEC_RAW: 'application/octet-stream',
+}
+
+FLAG_NONE = 0
+FLAG_DELTA = 1
+FLAG_KEYFRAME = 2
+
+FRAME_HEADER = struct.Struct('<IBBHH')
+DELTA_HEADER = struct.Struct('<HHH')
+
+
+def pack_frame(render:dict):
+    '''
+    Packs a render dict as produced by Trial.get_render into a binary
+    frame message: header followed by the encoded image bytes.
+    '''
+    flags = render.get('flags', FLAG_NONE)
+    header = FRAME_HEADER.pack(
+        render['frameId'] & 0xFFFFFFFF,
+        render['codec'],
+        flags,
+        render['width'],
+        render['height'])
+    if flags & FLAG_DELTA:
+        tiles = render['tiles']
+        header += DELTA_HEADER.pack(render['tileSize'], render['columns'], len(tiles))
+        header += struct.pack(f'<{len(tiles)}H', *tiles)
+    return header + render['frame']
+
+def unpack_frame(message:bytes):
+    '''
+    Inverse of pack_frame. Returns a render dict with the encoded image bytes
+    in 'frame'. Mostly useful for testing clients.
+    '''
+    frameId, codec, flags, width, height = FRAME_HEADER.unpack_from(message)
+    render = {
+        'frameId': frameId,
+        'codec': codec,
+        'flags': flags,
+        'width': width,
+        'height': height}
+    offset = FRAME_HEADER.size
+    if flags & FLAG_DELTA:
+        tileSize, columns, count = DELTA_HEADER.unpack_from(message, offset)
+        offset += DELTA_HEADER.size
+        render['tileSize'] = tileSize
+        render['columns'] = columns
+        render['tiles'] = list(struct.unpack_from(f'<{count}H', message, offset))
+        offset += 2 * count
+    render['frame'] = message[offset:]
+    return render
+
+def dump_json_frame(render:dict):
+    '''
+    Serializes a render dict into the original json frame message with a
+    base64 encoded image. Frames that are not jpeg also carry their mime type
+    and dimensions, jpeg frames are left exactly as old clients expect them.
+    Delta frames add a 'delta' entry describing the tile atlas and keyframes
+    are marked with 'keyframe': true.
+    '''
+    message = {
+        'frame': base64.b64encode(render['frame']).decode('utf-8'),
+        'frameId': render['frameId']}
+    if render.get('codec', CODEC_JPEG) != CODEC_JPEG:
+        message['codec'] = CODEC_MIME_TYPES[render['codec']]
+        message['width'] = render['width']
+        message['height'] = render['height']
+    flags = render.get('flags', FLAG_NONE)
+    if flags & FLAG_KEYFRAME:
+        message['keyframe'] = True
+    if flags & FLAG_DELTA:
+        message['width'] = render['width']
+        message['height'] = render['height']
+        message['delta'] = {
+            'tileSize': render['tileSize'],
+            'columns': render['columns'],
+            'tiles': list(render['tiles'])}
+    return json.dumps(message)
@@ -0,0 +1,966 @@
+'''
+Trial data recorders and readers.
+
+Originally every step was pickled on its own, observation arrays, info
+dict and all, which is slow to write and read and stores a pickle header
+per array. The columnar recorder instead buffers steps in chunks: values
+that have the same type and shape on every step of a chunk (observations,
+action, reward, done, frameId, ...) are copied into preallocated numpy
+blocks, anything else (info dicts, message fields) goes into a pickled
+side table of {stepInChunk: value} per field. Every chunkSteps steps the
+chunk is written as raw column blocks, and when the file is closed an
+index of all chunks is written as a footer.
+
+File layout:
+
+    MAGIC
+    chunk:  CHUNK_HEADER (json length) + json chunk entry, column blocks
+    ...
+    index:  json {'version', 'steps', 'chunks': [chunk entry, ...]}
+    FOOTER  (index length, MAGIC)
+
+A chunk entry is {'start', 'steps', 'size', 'columns': {name: {'offset',
+'length', 'dtype', 'shape'}}, 'ragged': {'offset', 'length'}} with offsets
+relative to the chunk's data, which starts on the ALIGNMENT boundary after
+its header. The index entries also hold that absolute 'data' offset. The
+headers in front of every chunk let a file whose writer died before
+writing the footer still be read up to its last complete chunk.
+
+Data is compressed as it is written so the finished file can be uploaded
+as is. Columnar files compress each column block and side table on its own
+(the chunk entry's 'compression', column 'length' is then the compressed
+size) so chunks can still be read independently. Pickle files are written
+through a streaming compressor and get the matching file extension.
+
+The format is chosen with the optional 'recordFormat' trial config entry:
+
+    recordFormat:
+      type: columnar       # columnar or pickle (one pickle per step)
+      chunkSteps: 64       # steps buffered per chunk
+      compression: gzip    # none, gzip, zstd or lz4
+      compressionLevel: 1  # optional, defaults to the compressor's default
+
+Adding a 'recordWriter' entry moves serialization and disk writes to a
+BackgroundRecorder thread, so filesystem stalls do not delay frames:
+
+    recordWriter:
+      queueSize: 128      # steps waiting to be written
+      whenFull: block     # block (wait for the writer) or drop (lose the step)
+
+zstd and lz4 need the zstandard and lz4 packages. read_steps and
+open_recording read either format with any compression, and old files
+gzipped by the Uploader, so older data keeps working. open_recording uses
+the chunk index to read single steps or ranges without loading the rest
+of the file, stream_steps reads a recording from start to end holding only
+a small part of it in memory. This module only depends on numpy (and the optional
+compressors) so Analysis code can import it too.
+
+Recordings made with 'actionRecording' (see regenerate.py) hold no
+observations. open_recording, stream_steps and read_steps regenerate them
+by replaying the recorded actions, which needs the environment packages;
+open_stored_recording and stream_stored_steps return the steps as stored.
+'''
+import bisect, gzip, io, itertools, json, logging, mmap, pickle, queue, struct, threading, time, zlib
+import numpy
+from io import BytesIO
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+FORMAT_PICKLE = 'pickle'
+FORMAT_COLUMNAR = 'columnar'
+
+MAGIC = b'HGREC1'
+CHUNK_HEADER = struct.Struct('<I')
+FOOTER = struct.Struct('<Q6s')
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+LZ4_MAGIC = b'\x04\x22\x4d\x18'
+# Column blocks start on this boundary so they can be viewed in place
+ALIGNMENT = 64
+VERSION = 1
+# Longer chunk headers are not headers, see iter_columnar_stream
+MAX_CHUNK_HEADER = 2**24
+
+
+COMPRESSION_NONE = 'none'
+COMPRESSION_GZIP = 'gzip'
+COMPRESSION_ZSTD = 'zstd'
+COMPRESSION_LZ4 = 'lz4'
+COMPRESSIONS = (COMPRESSION_NONE, COMPRESSION_GZIP, COMPRESSION_ZSTD, COMPRESSION_LZ4)
+EXTENSIONS = {COMPRESSION_NONE: '', COMPRESSION_GZIP: '.gz', COMPRESSION_ZSTD: '.zst', COMPRESSION_LZ4: '.lz4'}
+
+
+def check_compression(compression):
+    '''
+    Returns the normalized compression name, raising if it is unknown or its
+    package is not installed.
+    '''
+    compression = str(compression or COMPRESSION_NONE).strip().lower()
+    if compression not in COMPRESSIONS:
+        raise ValueError(f'Unknown recordFormat compression "{compression}", expected one of {COMPRESSIONS}')
+    if compression == COMPRESSION_ZSTD and zstandard is None:
+        raise ImportError('recordFormat compression zstd requires the zstandard package')
+    if compression == COMPRESSION_LZ4 and lz4 is None:
+        raise ImportError('recordFormat compression lz4 requires the lz4 package')
+    return compression
+
+def compress(data, compression:str, level=None):
+    '''
+    Compresses one block of a columnar file.
+    '''
+    if compression == COMPRESSION_GZIP:
+        return gzip.compress(data, 6 if level is None else level, mtime=0)
+    if compression == COMPRESSION_ZSTD:
+        return zstandard.ZstdCompressor(3 if level is None else level).compress(data)
+    if compression == COMPRESSION_LZ4:
+        return lz4.frame.compress(data, 0 if level is None else level)
+    return data
+
+def decompress(data, compression:str):
+    '''
+    Decompresses data written by compress, or a whole file written by a
+    streaming compressor, which can hold several concatenated frames.
+    '''
+    if compression == COMPRESSION_GZIP:
+        return gzip.decompress(data)
+    if compression == COMPRESSION_ZSTD:
+        check_compression(compression)
+        return zstandard.ZstdDecompressor().stream_reader(bytes(data), read_across_frames=True).read()
+    if compression == COMPRESSION_LZ4:
+        check_compression(compression)
+        with lz4.frame.open(BytesIO(data), 'rb') as infile:
+            return infile.read()
+    return data
+
+def open_compressed(path:str, compression:str, level=None):
+    '''
+    Opens path for appending through a streaming compressor.
+    '''
+    if compression == COMPRESSION_GZIP:
+        return gzip.open(path, 'ab', 6 if level is None else level)
+    if compression == COMPRESSION_ZSTD:
+        compressor = zstandard.ZstdCompressor(3 if level is None else level)
+        return compressor.stream_writer(open(path, 'ab'), closefd=True)
+    if compression == COMPRESSION_LZ4:
+        return lz4.frame.open(path, 'ab', compression_level=0 if level is None else level)
+    return open(path, 'ab')
+
+
+class StepRecord():
+    '''
+    The data recorded for one step, used as Trial.nextEntry. The fields
+    every step has are slots, anything else (message fields, feedback, ...)
+    goes into a dict that is only created when needed. It behaves like the
+    dict it replaces for everything the Trial and the recorders use.
+
+    A StepRecord owns its values: arrays the Agent returns are moved in,
+    not copied, and the recorders copy what they keep. Episode recording
+    writes and clears the same StepRecord every step. Trial mode and a
+    BackgroundRecorder (keeps_entries) keep it, see take, and the Trial
+    starts a new one.
+    '''
+    __slots__ = ('observation', 'raw_observation', 'action', 'reward', 'done', 'info', 'frameId', 'fields')
+    SLOTS = __slots__[:-1]
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        for name in self.SLOTS:
+            setattr(self, name, MISSING)
+        self.fields = None
+
+    def __setitem__(self, name:str, value):
+        if name in self.SLOTS:
+            setattr(self, name, value)
+        else:
+            if self.fields is None:
+                self.fields = {}
+            self.fields[name] = value
+
+    def __getitem__(self, name:str):
+        value = self.get(name, MISSING)
+        if value is MISSING:
+            raise KeyError(name)
+        return value
+
+    def get(self, name:str, default=None):
+        if name in self.SLOTS:
+            value = getattr(self, name)
+            return default if value is MISSING else value
+        if self.fields is None:
+            return default
+        return self.fields.get(name, default)
+
+    def __contains__(self, name:str):
+        return self.get(name, MISSING) is not MISSING
+
+    def update(self, values:dict):
+        for name, value in values.items():
+            self[name] = value
+
+    def items(self):
+        for name in self.SLOTS:
+            value = getattr(self, name)
+            if value is not MISSING:
+                yield name, value
+        if self.fields:
+            yield from self.fields.items()
+
+    def keys(self):
+        return [name for name, _ in self.items()]
+
+    def values(self):
+        return [value for _, value in self.items()]
+
+    def pop(self, name:str, default=None):
+        value = self.get(name, MISSING)
+        if value is MISSING:
+            return default
+        if name in self.SLOTS:
+            setattr(self, name, MISSING)
+        else:
+            del self.fields[name]
+        return value
+
+    def take(self):
+        '''
+        Returns this record for keeping, making sure it no longer shares
+        anything with the Agent or its environment: arrays that are views of
+        another buffer (e.g. an emulator screen that is updated in place)
+        are copied, the info dict is copied, everything else is kept as is.
+        '''
+        for name in ('observation', 'raw_observation'):
+            value = getattr(self, name)
+            if isinstance(value, numpy.ndarray) and not value.flags.owndata:
+                setattr(self, name, value.copy())
+        if isinstance(self.info, dict):
+            self.info = dict(self.info)
+        return self
+
+
+# Marks an unset StepRecord slot, None is a valid recorded value
+MISSING = object()
+
+
+def observation_checksum(observation):
+    '''
+    CRC32 of an observation array's bytes, recorded by action recordings to
+    check that regenerated observations match the original ones.
+    '''
+    return zlib.crc32(numpy.ascontiguousarray(observation))
+
+
+def entry_size(entry:dict):
+    '''
+    Rough size in bytes of a step, its arrays plus a fixed amount for the
+    other fields. Used to decide when a trial record is written out.
+    '''
+    size = 0
+    for value in entry.values():
+        size += value.nbytes if isinstance(value, numpy.ndarray) else 64
+    return size
+
+
+class PickleRecorder():
+    '''
+    The original format: one pickle per step appended to the file. In trial
+    mode the record is pickled as a list, a long trial is written in several
+    segments that are each a list. With compression the
+    pickles are streamed through the compressor and the file name gets the
+    compressor's extension.
+    '''
+    def __init__(self, path:str, compression:str=COMPRESSION_NONE, compressionLevel:int=None):
+        self.compression = check_compression(compression)
+        self.compressed = self.compression != COMPRESSION_NONE
+        self.keeps_entries = False
+        self.path = path + EXTENSIONS[self.compression]
+        self.outfile = open_compressed(self.path, self.compression, compressionLevel)
+
+    def append(self, entry:dict):
+        pickle.dump(dict(entry.items()), self.outfile)
+
+    def append_record(self, record:list):
+        pickle.dump([dict(entry.items()) for entry in record], self.outfile)
+
+    def close(self):
+        self.outfile.close()
+
+
+def column_type(value):
+    '''
+    Returns (dtype, shape) if value can be stored in a typed column,
+    otherwise None and it goes to the side table.
+    '''
+    if isinstance(value, numpy.ndarray):
+        if value.dtype.hasobject:
+            return None
+        return value.dtype, value.shape
+    if isinstance(value, (bool, numpy.bool_)):
+        return numpy.dtype('?'), ()
+    if isinstance(value, (int, numpy.integer)):
+        return numpy.dtype('<i8'), ()
+    if isinstance(value, (float, numpy.floating)):
+        return numpy.dtype('<f8'), ()
+    return None
+
+
+class ColumnarRecorder():
+    '''
+    Writes steps in the chunked columnar format described above. Column
+    blocks are kept after a chunk is written and reused by the next chunk
+    if it has the same columns, so steady state recording does not allocate.
+    '''
+    def __init__(self, path:str, chunkSteps:int=64, compression:str=COMPRESSION_NONE, compressionLevel:int=None):
+        self.compression = check_compression(compression)
+        self.compressed = self.compression != COMPRESSION_NONE
+        self.keeps_entries = False
+        self.level = compressionLevel
+        self.path = path
+        self.outfile = open(path, 'wb')
+        self.chunk_steps = chunkSteps
+        self.outfile.write(MAGIC)
+        self.position = len(MAGIC)
+        self.chunks = []
+        self.steps = 0
+        self.count = 0
+        self.columns = {}
+        self.ragged = {}
+        self.spare = {}
+
+    def append(self, entry:dict):
+        '''
+        Adds one step. Values are copied into the column blocks, so the
+        entry can be reused by the caller.
+        '''
+        i = self.count
+        for name in list(self.columns):
+            if name not in entry:
+                self.to_ragged(name)
+        for name, value in entry.items():
+            block = self.columns.get(name)
+            if block is None:
+                if i == 0:
+                    block = self.new_column(name, value)
+                if block is None:
+                    self.ragged.setdefault(name, {})[i] = value
+                    continue
+            if not self.store(block, i, value):
+                self.to_ragged(name)
+                self.ragged[name][i] = value
+        self.count += 1
+        if self.count >= self.chunk_steps:
+            self.flush()
+
+    def append_record(self, record:list):
+        for entry in record:
+            self.append(entry)
+
+    def new_column(self, name:str, value):
+        '''
+        Returns a block for a new typed column, or None if the value can not
+        be stored in one.
+        '''
+        kind = column_type(value)
+        if kind is None:
+            return None
+        dtype, shape = kind
+        block = self.spare.pop((name, dtype.str, shape), None)
+        if block is None:
+            block = numpy.empty((self.chunk_steps,) + shape, dtype)
+        self.columns[name] = block
+        return block
+
+    def store(self, block:numpy.ndarray, i:int, value):
+        '''
+        Copies value into row i of the block, returns False if it does not
+        have the block's type and shape.
+        '''
+        kind = column_type(value)
+        if kind is None or kind[1] != block.shape[1:]:
+            return False
+        if kind[0] != block.dtype:
+            return False
+        try:
+            block[i] = value
+        except OverflowError:
+            return False
+        return True
+
+    def to_ragged(self, name:str):
+        '''
+        Moves a typed column of the current chunk to the side table.
+        '''
+        block = self.columns.pop(name)
+        values = self.ragged.setdefault(name, {})
+        for i in range(self.count):
+            values[i] = block[i].copy() if block.ndim > 1 else block[i].item()
+
+    def align(self):
+        padding = -self.position % ALIGNMENT
+        if padding:
+            self.outfile.write(bytes(padding))
+            self.position += padding
+
+    def write(self, data):
+        self.outfile.write(data)
+        self.position += memoryview(data).nbytes
+
+    def flush(self):
+        '''
+        Writes the buffered steps as a chunk.
+        '''
+        if self.count == 0:
+            return
+        count = self.count
+        blocks = [block[:count] for block in self.columns.values()]
+        ragged = pickle.dumps(self.ragged, protocol=pickle.HIGHEST_PROTOCOL)
+        if self.compression != COMPRESSION_NONE:
+            blocks = [compress(block.data, self.compression, self.level) for block in blocks]
+            ragged = compress(ragged, self.compression, self.level)
+        offset = 0
+        columns = {}
+        for (name, block), data in zip(self.columns.items(), blocks):
+            offset += -offset % ALIGNMENT
+            length = memoryview(data).nbytes
+            columns[name] = {'offset': offset, 'length': length,
+                             'dtype': block.dtype.str, 'shape': list(block.shape[1:])}
+            offset += length
+        entry = {'start': self.steps, 'steps': count, 'compression': self.compression, 'columns': columns,
+                 'ragged': {'offset': offset, 'length': len(ragged)}, 'size': offset + len(ragged)}
+        header = json.dumps(entry).encode('utf-8')
+        self.write(CHUNK_HEADER.pack(len(header)) + header)
+        self.align()
+        entry['data'] = self.position
+        for data in blocks:
+            self.align()
+            self.write(data)
+        for name, block in self.columns.items():
+            self.spare[(name, block.dtype.str, block.shape[1:])] = block
+        self.write(ragged)
+        self.chunks.append(entry)
+        self.steps += count
+        self.count = 0
+        self.columns = {}
+        self.ragged = {}
+
+    def close(self):
+        '''
+        Writes the last chunk and the index footer.
+        '''
+        if self.outfile.closed:
+            return
+        self.flush()
+        index = json.dumps({'version': VERSION, 'steps': self.steps, 'chunks': self.chunks}).encode('utf-8')
+        self.outfile.write(index)
+        self.outfile.write(FOOTER.pack(len(index), MAGIC))
+        self.outfile.close()
+        self.spare = {}
+
+
+WHEN_FULL_BLOCK = 'block'
+WHEN_FULL_DROP = 'drop'
+WHEN_FULL_POLICIES = (WHEN_FULL_BLOCK, WHEN_FULL_DROP)
+
+
+class BackgroundRecorder():
+    '''
+    Wraps a recorder so steps are written by a thread. append only queues
+    the step, which the recorder then owns (see StepRecord.take). When the
+    queue is full the Trial either waits for the writer (block) or the step
+    is not recorded (drop). close writes everything still queued, so once
+    it returns the file is complete and can be uploaded.
+    '''
+    def __init__(self, recorder, queueSize:int=128, whenFull:str=WHEN_FULL_BLOCK):
+        if whenFull not in WHEN_FULL_POLICIES:
+            raise ValueError(f'Unknown recordWriter whenFull "{whenFull}", expected one of {WHEN_FULL_POLICIES}')
+        self.recorder = recorder
+        self.path = recorder.path
+        self.compressed = recorder.compressed
+        self.keeps_entries = True
+        self.block = whenFull == WHEN_FULL_BLOCK
+        self.queue = queue.Queue(maxsize=queueSize)
+        self.error = None
+        self.dropped = 0
+        self.blocked_seconds = 0.0
+        self.max_depth = 0
+        self.thread = threading.Thread(target=self.write, name='recorder', daemon=True)
+        self.thread.start()
+
+    def write(self):
+        while True:
+            method, item = self.queue.get()
+            if method is None:
+                return
+            if self.error is not None:
+                continue
+            try:
+                method(item)
+            except Exception as error:
+                logging.exception(f'Writing {self.path} failed.')
+                self.error = error
+
+    def put(self, method, item):
+        if self.error is not None:
+            raise self.error
+        try:
+            self.queue.put_nowait((method, item))
+        except queue.Full:
+            if not self.block:
+                self.dropped += 1
+                return
+            start = time.monotonic()
+            self.queue.put((method, item))
+            self.blocked_seconds += time.monotonic() - start
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    def append(self, entry):
+        self.put(self.recorder.append, entry.take() if isinstance(entry, StepRecord) else entry)
+
+    def append_record(self, record:list):
+        self.put(self.recorder.append_record, record)
+
+    def report(self):
+        return {'droppedSteps': self.dropped, 'maxQueueDepth': self.max_depth,
+                'blockedSeconds': round(self.blocked_seconds, 4)}
+
+    def close(self):
+        '''
+        Waits for the queued steps to be written and closes the file.
+        '''
+        if not self.thread.is_alive():
+            return
+        self.queue.put((None, None))
+        self.thread.join()
+        logging.info(f'Record writer report for {self.path}: {self.report()}')
+        self.recorder.close()
+        if self.error is not None:
+            raise self.error
+
+
+RECORDERS = {FORMAT_PICKLE: PickleRecorder, FORMAT_COLUMNAR: ColumnarRecorder}
+
+def make_recorder(path:str, record_config=None, writer_config=None):
+    '''
+    Creates the recorder described by the 'recordFormat' config entry, which
+    can be None (columnar), the format name, or a dict with a 'type' and its
+    options. The recorder's path is the file actually written, which has an
+    extension added for compressed pickle files.
+    If the 'recordWriter' entry is given the recorder writes on a thread.
+    '''
+    if record_config is None:
+        record_config = {}
+    elif isinstance(record_config, str):
+        record_config = {'type': record_config}
+    options = dict(record_config)
+    record_format = str(options.pop('type', FORMAT_COLUMNAR)).strip().lower()
+    if record_format not in RECORDERS:
+        raise ValueError(f'Unknown recordFormat type "{record_format}", expected one of {list(RECORDERS)}')
+    recorder = RECORDERS[record_format](path, **options)
+    if writer_config:
+        if not isinstance(writer_config, dict):
+            writer_config = {}
+        recorder = BackgroundRecorder(recorder, **writer_config)
+    return recorder
+
+
+class ColumnarReader():
+    '''
+    Reads a columnar recording from a bytes-like buffer (bytes, mmap, ...).
+    Typed columns are numpy views into the buffer, nothing is copied until
+    steps are built from them.
+    '''
+    def __init__(self, buffer, chunks=None):
+        self.buffer = memoryview(buffer)
+        if chunks is None:
+            if bytes(self.buffer[:len(MAGIC)]) != MAGIC:
+                raise ValueError('Not a columnar recording')
+            chunks = self.read_index()
+        self.chunks = chunks
+        self.starts = [chunk['start'] for chunk in self.chunks]
+        self.steps = sum(chunk['steps'] for chunk in self.chunks)
+        self.cached_chunk = None
+        self.cached = None
+
+    def read_index(self):
+        '''
+        Returns the chunk entries from the footer, or by walking the chunk
+        headers if the file was not closed properly.
+        '''
+        size = len(self.buffer)
+        if size >= len(MAGIC) + FOOTER.size:
+            length, magic = FOOTER.unpack_from(self.buffer, size - FOOTER.size)
+            if magic == MAGIC and length <= size - FOOTER.size:
+                start = size - FOOTER.size - length
+                try:
+                    return json.loads(bytes(self.buffer[start:start + length]))['chunks']
+                except ValueError:
+                    pass
+        chunks = []
+        position = len(MAGIC)
+        while position + CHUNK_HEADER.size <= size:
+            length, = CHUNK_HEADER.unpack_from(self.buffer, position)
+            position += CHUNK_HEADER.size
+            try:
+                entry = json.loads(bytes(self.buffer[position:position + length]))
+            except ValueError:
+                break
+            position += length
+            position += -position % ALIGNMENT
+            if not isinstance(entry, dict) or 'size' not in entry or position + entry['size'] > size:
+                break
+            entry['data'] = position
+            chunks.append(entry)
+            position += entry['size']
+        return chunks
+
+    def __len__(self):
+        return self.steps
+
+    def read_chunk(self, chunk:dict, fields=None):
+        '''
+        Returns ({name: column array}, {name: {stepInChunk: value}}) for a
+        chunk. If fields is given only those columns are read, the others
+        (e.g. observations) are not decompressed at all.
+        '''
+        compression = chunk.get('compression', COMPRESSION_NONE)
+        columns = {}
+        for name, column in chunk['columns'].items():
+            if fields is not None and name not in fields:
+                continue
+            shape = (chunk['steps'],) + tuple(column['shape'])
+            start = chunk['data'] + column['offset']
+            if compression == COMPRESSION_NONE:
+                data, start = self.buffer, start
+            else:
+                data, start = decompress(self.buffer[start:start + column['length']], compression), 0
+            columns[name] = numpy.frombuffer(data, numpy.dtype(column['dtype']),
+                count=int(numpy.prod(shape)), offset=start).reshape(shape)
+        start = chunk['data'] + chunk['ragged']['offset']
+        side = pickle.loads(decompress(self.buffer[start:start + chunk['ragged']['length']], compression))
+        if fields is not None:
+            side = project(side, fields)
+        return columns, side
+
+    def decoded(self, k:int, fields=None):
+        '''
+        Returns the columns and side table of chunk k ready to build steps
+        from. The last chunk used is kept, so reading steps in order only
+        decodes each chunk once.
+        '''
+        key = (k, fields)
+        if self.cached_chunk != key:
+            columns, side = self.read_chunk(self.chunks[k], fields)
+            # Scalar columns are turned into python values in one go
+            columns = {name: values if values.ndim > 1 else values.tolist() for name, values in columns.items()}
+            self.cached = columns, side
+            self.cached_chunk = key
+        return self.cached
+
+    def chunk_step(self, k:int, i:int, fields=None):
+        '''
+        Returns step i of chunk k as a dict, like the one recorded, or only
+        its fields if given. Array values are read-only views into the
+        buffer.
+        '''
+        columns, side = self.decoded(k, fields)
+        step = {name: values[i] for name, values in columns.items()}
+        for name, values in side.items():
+            if i in values:
+                step[name] = values[i]
+        return step
+
+    def step(self, index:int):
+        '''
+        Returns a single step, only its chunk is read.
+        '''
+        if index < 0:
+            index += self.steps
+        if not 0 <= index < self.steps:
+            raise IndexError(f'Step {index} out of range, the recording has {self.steps} steps')
+        k = bisect.bisect_right(self.starts, index) - 1
+        return self.chunk_step(k, index - self.starts[k])
+
+    def iter_steps(self, start:int=0, stop:int=None, fields=None):
+        '''
+        Yields the steps from start up to stop, reading only the chunks
+        that hold them. fields, a frozenset of names, selects the fields
+        that are read.
+        '''
+        start, stop, _ = slice(start, stop).indices(self.steps)
+        if start >= stop:
+            return
+        k = bisect.bisect_right(self.starts, start) - 1
+        while k < len(self.chunks) and self.starts[k] < stop:
+            chunk = self.chunks[k]
+            first = max(start - chunk['start'], 0)
+            last = min(stop - chunk['start'], chunk['steps'])
+            for i in range(first, last):
+                yield self.chunk_step(k, i, fields)
+            k += 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            if index.step not in (None, 1):
+                return [self.step(i) for i in range(*index.indices(self.steps))]
+            return list(self.iter_steps(index.start, index.stop))
+        return self.step(index)
+
+    def __iter__(self):
+        return self.iter_steps()
+
+
+class PickleReader():
+    '''
+    Same interface as ColumnarReader for pickle recordings. They have no
+    index, so every step is loaded up front.
+    '''
+    def __init__(self, data:bytes):
+        self.step_list = read_pickles(data)
+
+    def __len__(self):
+        return len(self.step_list)
+
+    def step(self, index:int):
+        return self.step_list[index]
+
+    def iter_steps(self, start:int=0, stop:int=None, fields=None):
+        if fields is None:
+            return iter(self.step_list[start:stop])
+        return (project(step, fields) for step in self.step_list[start:stop])
+
+    def __getitem__(self, index):
+        return self.step_list[index]
+
+    def __iter__(self):
+        return iter(self.step_list)
+
+
+def project(step:dict, fields):
+    '''
+    Returns the entries of step whose names are in fields.
+    '''
+    return {name: value for name, value in step.items() if name in fields}
+
+def is_columnar(path:str):
+    '''
+    Whether the file at path is a columnar recording that is not
+    compressed as a whole, which can be memory-mapped.
+    '''
+    with open(path, 'rb') as infile:
+        return infile.read(len(MAGIC)) == MAGIC
+
+
+STREAM_MAGICS = {GZIP_MAGIC: COMPRESSION_GZIP, ZSTD_MAGIC: COMPRESSION_ZSTD, LZ4_MAGIC: COMPRESSION_LZ4}
+
+def read_file(path:str):
+    '''
+    Returns the contents of a recording, decompressed if the whole file was
+    written through a compressor.
+    '''
+    with open(path, 'rb') as infile:
+        data = infile.read()
+    for magic, compression in STREAM_MAGICS.items():
+        if data[:len(magic)] == magic:
+            return decompress(data, compression)
+    return data
+
+def read_pickles(data:bytes):
+    '''
+    Returns the steps of a pickle recording. Trial mode files hold pickled
+    lists of steps, one per segment, that are joined into one list.
+    '''
+    steps = []
+    infile = BytesIO(data)
+    while infile.tell() < len(data):
+        steps.append(pickle.load(infile))
+    if steps and all(isinstance(segment, list) for segment in steps):
+        steps = [step for segment in steps for step in segment]
+    return steps
+
+def open_recording(path:str):
+    '''
+    Returns a reader for a recording of any format: reader[i] is step i,
+    reader[start:stop] a list of steps, iterating yields every step.
+    Columnar files that are not wrapped in a compressor as a whole (e.g. by
+    the Uploader) are memory-mapped and only the chunks read are loaded,
+    so single steps of a multi-GB episode are quick to get. Action
+    recordings are wrapped in a regenerate.RegeneratedRecording.
+    '''
+    reader = open_stored_recording(path)
+    if is_action_recording(reader):
+        # Imported here, regenerating needs the environment packages
+        from regenerate import RegeneratedRecording
+        return RegeneratedRecording(reader)
+    return reader
+
+def is_action_recording(reader):
+    '''
+    Whether a stored recording was made with 'actionRecording', whose first
+    step holds what is needed to regenerate the episode.
+    '''
+    return len(reader) > 0 and 'regenerate' in reader.step(0)
+
+def open_stored_recording(path:str):
+    '''
+    Returns a reader for a recording as it is stored, see open_recording.
+    '''
+    with open(path, 'rb') as infile:
+        if infile.read(len(MAGIC)) == MAGIC:
+            return ColumnarReader(mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ))
+    data = read_file(path)
+    if data[:len(MAGIC)] == MAGIC:
+        return ColumnarReader(data)
+    return PickleReader(data)
+
+def open_stream(path:str):
+    '''
+    Opens a recording for sequential reading, through a streaming
+    decompressor if the whole file is compressed.
+    '''
+    with open(path, 'rb') as infile:
+        head = infile.read(8)
+    if head.startswith(GZIP_MAGIC):
+        return gzip.open(path, 'rb')
+    if head.startswith(ZSTD_MAGIC):
+        check_compression(COMPRESSION_ZSTD)
+        reader = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), read_across_frames=True, closefd=True)
+        return io.BufferedReader(reader)
+    if head.startswith(LZ4_MAGIC):
+        check_compression(COMPRESSION_LZ4)
+        return lz4.frame.open(path, 'rb')
+    return open(path, 'rb')
+
+def stream_steps(path:str):
+    '''
+    Yields the steps of a recording one at a time, see stream_stored_steps.
+    The observations of action recordings are regenerated as they are read.
+    '''
+    steps = stream_stored_steps(path)
+    first = next(steps, None)
+    if first is None:
+        return
+    if 'regenerate' in first:
+        from regenerate import regenerate_steps
+        steps = regenerate_steps(itertools.chain([first], steps))
+    else:
+        yield first
+    yield from steps
+
+def stream_stored_steps(path:str, fields=None):
+    '''
+    Yields the steps of a recording as stored one at a time, holding as
+    little of it in memory as the format allows: columnar files are
+    memory-mapped or read through their decompressor a chunk at a time,
+    pickle files are unpickled step by step (a trial mode segment at a
+    time). fields, a frozenset of names, selects the fields returned,
+    columnar files then skip decoding the other columns.
+    '''
+    if is_columnar(path):
+        yield from open_stored_recording(path).iter_steps(fields=fields)
+        return
+    with open_stream(path) as infile:
+        if infile.peek(len(MAGIC))[:len(MAGIC)] == MAGIC:
+            yield from iter_columnar_stream(infile, fields)
+            return
+        while infile.peek(1):
+            steps = pickle.load(infile)
+            if not isinstance(steps, list):
+                steps = [steps]
+            for step in steps:
+                yield step if fields is None else project(step, fields)
+
+def iter_columnar_stream(infile, fields=None):
+    '''
+    Yields the steps of a columnar recording read front to back from a file
+    object, e.g. the decompressor of a file compressed as a whole, with one
+    chunk in memory at a time. Reading stops at the index after the last
+    chunk, whose first bytes read as a chunk header longer than
+    MAX_CHUNK_HEADER, or after the last complete chunk.
+    '''
+    if infile.read(len(MAGIC)) != MAGIC:
+        raise ValueError('Not a columnar recording')
+    position = len(MAGIC)
+    while True:
+        head = infile.read(CHUNK_HEADER.size)
+        if len(head) < CHUNK_HEADER.size:
+            return
+        length, = CHUNK_HEADER.unpack(head)
+        if length > MAX_CHUNK_HEADER:
+            return
+        try:
+            entry = json.loads(infile.read(length))
+        except ValueError:
+            return
+        if not isinstance(entry, dict) or 'size' not in entry:
+            return
+        position += CHUNK_HEADER.size + length
+        padding = -position % ALIGNMENT
+        data = infile.read(padding + entry['size'])
+        if len(data) < padding + entry['size']:
+            return
+        position += len(data)
+        # Read as a recording of just this chunk
+        chunk = dict(entry, start=0, data=padding)
+        yield from ColumnarReader(data, [chunk]).iter_steps(fields=fields)
+
+
+class ReadAhead():
+    '''
+    Iterates over steps read ahead by a thread, at most size steps are
+    waiting, so the caller does not wait for disk reads or decompression.
+    '''
+    def __init__(self, steps, size:int=64):
+        self.queue = queue.Queue(maxsize=size)
+        self.steps = steps
+        self.closed = False
+        self.thread = threading.Thread(target=self.read, name='readahead', daemon=True)
+        self.thread.start()
+
+    def read(self):
+        try:
+            for step in self.steps:
+                if self.closed:
+                    return
+                self.queue.put((step, None))
+        except Exception as error:
+            self.queue.put((None, error))
+            return
+        self.queue.put((MISSING, None))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        step, error = self.queue.get()
+        if error is not None:
+            raise error
+        if step is MISSING:
+            self.queue.put((MISSING, None))
+            raise StopIteration
+        return step
+
+    def close(self):
+        '''
+        Stops the reading thread.
+        '''
+        self.closed = True
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+def read_steps(path:str):
+    '''
+    Returns every step of a recording as a list of dicts, whatever its
+    format and whether or not it is gzipped.
+    '''
+    return list(open_recording(path))
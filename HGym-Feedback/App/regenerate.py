@@ -0,0 +1,134 @@
+'''
+Action recordings: play_game episodes recorded without their observations.
+
+ALE environments are made with repeat_action_probability=0 (see
+Agent.start) and the Mario emulator is deterministic, so an episode is
+fully determined by the seed it was reset with and the actions taken.
+With the optional 'actionRecording' trial config entry the Trial resets
+every episode with a fresh seed and records steps without 'observation'
+and 'raw_observation'. The first step of each episode gets a 'regenerate'
+entry {'game', 'frameskip', 'maxEpisodeFrames', 'seed'}, and every
+checksumInterval steps (and on the first and last step) a 'checksum' of
+the observation, see recording.observation_checksum.
+
+    actionRecording:
+      checksumInterval: 100  # steps between observation checksums
+
+Everything else is recorded as usual, so a recording is a few bytes per
+step instead of a screen. The observations are regenerated when the
+recording is read: an Agent is started the same way the Trial started it,
+reset with the seed and stepped with the recorded actions. A checksum or
+reward that does not match means the replay diverged from what the
+participant saw (e.g. a different environment version or a nondeterministic
+Agent) and raises a ValueError.
+
+recording.open_recording and recording.stream_steps do this transparently,
+so ReplayAgent, the frame stores built by updateProject.py and
+Analysis/data_utils.py read action recordings like any other. Regenerating
+needs the environment packages and takes about as long as playing the
+episode, a ReplayCache keeps the regenerated replay for feedback sessions.
+'''
+import bisect, logging
+import numpy
+from agent import Agent
+from recording import observation_checksum, project
+
+OBSERVATION_FIELDS = frozenset(('observation', 'raw_observation'))
+
+
+def regenerate_steps(steps):
+    '''
+    Yields the steps of an action recording with their observations
+    regenerated. steps must start at the beginning of an episode. Agents
+    are reused across the episodes of a trial mode recording.
+    '''
+    agents = {}
+    agent = None
+    try:
+        for idx, step in enumerate(steps):
+            spec = step.get('regenerate')
+            if spec is not None:
+                key = (spec['game'], spec.get('frameskip', 1), spec.get('maxEpisodeFrames', -1))
+                agent = agents.get(key)
+                if agent is None:
+                    agent = agents[key] = Agent()
+                    agent.start(*key)
+                agent.reset(spec['seed'])
+            elif agent is None:
+                raise ValueError('Cannot regenerate steps that do not start at the beginning of an episode')
+            yield regenerate_step(agent, step, idx)
+    finally:
+        for started in agents.values():
+            started.close()
+
+def regenerate_step(agent, step:dict, idx:int):
+    '''
+    Steps agent with the recorded action and returns the step with the
+    regenerated observations, checking them against the recorded checksum.
+    '''
+    state = agent.step(step['action'])
+    observation = state['observation']
+    if 'checksum' in step and observation_checksum(observation) != step['checksum']:
+        raise ValueError(f'Regenerated observation of step {idx} does not match its checksum, '
+                         + 'the replay diverged from the recording')
+    if 'reward' in step and state['reward'] != step['reward']:
+        raise ValueError(f'Regenerated reward of step {idx} is {state["reward"]}, {step["reward"]} was recorded, '
+                         + 'the replay diverged from the recording')
+    step = dict(step)
+    # The environment may reuse its buffers, the returned steps keep theirs
+    step['observation'] = numpy.array(observation)
+    if 'raw_observation' in state:
+        step['raw_observation'] = numpy.array(state['raw_observation'])
+    return step
+
+
+class RegeneratedRecording():
+    '''
+    Same interface as recording.ColumnarReader for an action recording.
+    Reading a step regenerates its episode from the start up to that step,
+    so reading in order (iterating, slices) is much cheaper than reading
+    steps one at a time.
+    '''
+    def __init__(self, reader):
+        self.reader = reader
+        self.episode_starts = [idx for idx, step in enumerate(reader) if 'regenerate' in step]
+        logging.info(f'Regenerating observations of an action recording with {len(self.episode_starts)} episodes')
+
+    def __len__(self):
+        return len(self.reader)
+
+    def step(self, index:int):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f'Step {index} out of range, the recording has {len(self)} steps')
+        return next(self.iter_steps(index, index + 1))
+
+    def iter_steps(self, start:int=0, stop:int=None, fields=None):
+        '''
+        Yields the steps from start up to stop, regenerating from the
+        beginning of the episode start is in. If fields are given and do not
+        include observations nothing is regenerated.
+        '''
+        if fields is not None and not fields & OBSERVATION_FIELDS:
+            yield from self.reader.iter_steps(start, stop, fields)
+            return
+        start, stop, _ = slice(start, stop).indices(len(self))
+        if start >= stop:
+            return
+        first = self.episode_starts[max(bisect.bisect_right(self.episode_starts, start) - 1, 0)]
+        steps = regenerate_steps(self.reader.iter_steps(first, stop))
+        for idx, step in enumerate(steps, first):
+            if idx < start:
+                continue
+            yield step if fields is None else project(step, fields)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            if index.step not in (None, 1):
+                return [self.step(i) for i in range(*index.indices(len(self)))]
+            return list(self.iter_steps(index.start, index.stop))
+        return self.step(index)
+
+    def __iter__(self):
+        return self.iter_steps()
@@ -0,0 +1,176 @@
+'''
+Server-wide cache of decoded replays for feedback trials.
+
+Every give_feedback session with the same trial_idx replays the same file,
+and replays are usually gzipped pickles that each session would decode on
+its own. With the optional 'replayCache' trial config entry the first
+session to need a replay decodes it once into an uncompressed columnar
+recording (see recording.py) in the cache directory, and every session
+memory-maps that file, so all of them share one read-only copy in the OS
+page cache. ReplayAgent is given the cache and opens its replay through it.
+
+    replayCache:
+      directory: ReplayCache   # on disk, the page cache keeps replays in use in memory
+      maxMB: 1024              # total size kept, least recently used replays are removed
+
+The cache lives in the filesystem so it works the same for trials in their
+own processes, warm workers and session hosts. A directory in /dev/shm
+avoids the disk entirely but shares its space with the frame rings
+(framering.py), which crash the communicator when /dev/shm is full. Docker
+only gives containers 64MB of /dev/shm unless they are run with a larger
+--shm-size, which holds a few hundred steps of a decoded Atari replay. A replay is decoded into a
+temporary file and renamed into place, sessions that need it meanwhile
+wait for it. Removing a replay that is still being played is safe, the
+sessions that have it mapped keep their pages until they end.
+'''
+import hashlib, logging, os, time
+from recording import COMPRESSION_NONE, ColumnarRecorder, open_recording, open_stored_recording, \
+    is_action_recording, is_columnar, stream_steps
+
+# A decode taking longer than this is assumed to have died with its process
+STALE_SECONDS = 120
+POLL_SECONDS = 0.05
+
+
+class ReplayCache():
+    def __init__(self, directory:str='ReplayCache', maxMB:float=1024):
+        self.directory = directory
+        self.max_bytes = maxMB * 2**20
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, source:str):
+        '''
+        Name of the cached copy of source, which changes if the source file
+        is replaced.
+        '''
+        stat = os.stat(source)
+        digest = hashlib.sha1(f'{os.path.abspath(source)}:{stat.st_size}:{stat.st_mtime_ns}'.encode('utf-8'))
+        return f'{os.path.basename(source)}-{digest.hexdigest()[:16]}'
+
+    def get(self, source:str):
+        '''
+        Returns the path of a memory-mappable copy of the replay at source,
+        decoding it first if it is not cached yet. Uncompressed columnar
+        replays are already shareable and returned as they are.
+        '''
+        if is_mappable(source):
+            return source
+        path = os.path.join(self.directory, self.key(source))
+        pending = path + '.decoding'
+        while True:
+            if os.path.exists(path):
+                # The modification time orders the cache for eviction
+                os.utime(path)
+                return path
+            try:
+                fd = os.open(pending, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                self.wait_for(pending)
+                continue
+            os.close(fd)
+            try:
+                self.decode(source, pending)
+                os.replace(pending, path)
+            except Exception:
+                if os.path.exists(pending):
+                    os.remove(pending)
+                raise
+            self.evict(keep=path)
+            return path
+
+    def find(self, source:str):
+        '''
+        Returns the path of a memory-mappable copy of the replay at source
+        if there already is one, without decoding it.
+        '''
+        if is_mappable(source):
+            return source
+        path = os.path.join(self.directory, self.key(source))
+        if not os.path.exists(path):
+            return None
+        os.utime(path)
+        return path
+
+    def open(self, source:str):
+        '''
+        Returns a memory-mapped reader of the replay at source, see get. A
+        replay evicted by another session between get and opening it is
+        decoded again.
+        '''
+        while True:
+            path = self.get(source)
+            try:
+                return open_recording(path)
+            except FileNotFoundError:
+                continue
+
+    def wait_for(self, pending:str):
+        '''
+        Waits while another session decodes a replay. A decode that was
+        abandoned by a dead process is removed so it can be restarted.
+        '''
+        while os.path.exists(pending):
+            try:
+                if time.time() - os.path.getmtime(pending) > STALE_SECONDS:
+                    logging.info(f'Removing stale replay decode {pending}')
+                    os.remove(pending)
+                    return
+            except FileNotFoundError:
+                return
+            time.sleep(POLL_SECONDS)
+
+    def decode(self, source:str, path:str):
+        start = time.monotonic()
+        # Reopens the empty file that claimed the decode
+        recorder = ColumnarRecorder(path, compression=COMPRESSION_NONE)
+        for step in stream_steps(source):
+            recorder.append(step)
+        recorder.close()
+        logging.info(f'Decoded replay {source} into {path} in {time.monotonic() - start:.2f}s')
+
+    def evict(self, keep:str=None):
+        '''
+        Removes the least recently used replays until the cache fits in
+        maxMB, never the replay that was just added. A replay larger than
+        maxMB on its own is kept while it is played, and logged.
+        '''
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.decoding') or path == keep:
+                continue
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        if keep is not None and os.path.exists(keep):
+            kept = os.path.getsize(keep)
+            if kept > self.max_bytes:
+                logging.warning(f'Cached replay {keep} is {kept / 2**20:.0f}MB, more than the replayCache '
+                                + f'maxMB of {self.max_bytes / 2**20:.0f}MB, the cache is over budget until it is evicted')
+            total += kept
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            logging.info(f'Evicting cached replay {path}')
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def is_mappable(path:str):
+    '''
+    Whether a replay file can be memory-mapped as it is: a columnar
+    recording whose chunks are not compressed. Action recordings are not,
+    their observations have to be regenerated first.
+    '''
+    if not is_columnar(path):
+        return False
+    reader = open_stored_recording(path)
+    if is_action_recording(reader):
+        return False
+    return all(chunk.get('compression', COMPRESSION_NONE) == COMPRESSION_NONE for chunk in reader.chunks)
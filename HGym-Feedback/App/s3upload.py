@@ -1,21 +1,189 @@
-import gzip
-import os
+'''
+Uploads recorded trial data to S3 from one long-lived process per server.
+
+The communicator used to start a new process per episode file, each one
+importing boto3, building an S3 resource and trying a single upload whose
+failure was lost. UploadService instead runs one upload process for the
+whole server. Uploads are written to a spool directory as small json jobs
+before anything is sent, so uploads that were queued or in progress when
+the server stopped are resumed by the next one. The process shares one S3
+client between a few upload threads, large files are sent as concurrent
+multipart uploads, and a failed upload is retried with exponential backoff.
+Uploads that still fail after maxAttempts, or whose file is gone, are
+moved to the spool's failed directory and logged as errors.
+
+Configured with the optional 'uploadService' trial config entry:
+
+    uploadService:
+      spool: UploadSpool   # directory holding the queued uploads
+      workers: 4           # files uploaded at the same time
+      partsPerUpload: 4    # concurrent parts of one multipart upload
+      multipartMB: 8       # files larger than this are sent in parts of this size
+      maxAttempts: 8       # tries before an upload is given up
+      retryDelay: 1.0      # seconds before the first retry, doubled for each one after
+      maxRetryDelay: 300   # longest wait between tries
+      endpointUrl:         # optional, an S3 compatible server such as MinIO or moto
+
+A job is the 'upload' message a Trial sends: {'projectId', 'userId',
+'file', 'path', 'bucket', 'gzip'}. Recordings compressed while they were
+written (see recording.py) are sent with gzip False and uploaded as they
+are, others are gzipped first.
+'''
+import gzip, json, logging, os, random, shutil, time, uuid
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Event, Process
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from dotenv import load_dotenv
 
 load_dotenv()
 
-class Uploader:
-    def __init__(self, projectId, userId, file, path, bucket, compress=False):
-        if compress:
+JOB_EXTENSION = '.json'
+
+
+class UploadService():
+    def __init__(self, spool:str='UploadSpool', workers:int=4, partsPerUpload:int=4, multipartMB:float=8,
+                 maxAttempts:int=8, retryDelay:float=1.0, maxRetryDelay:float=300, endpointUrl:str=None,
+                 pollInterval:float=1.0):
+        self.spool = spool
+        self.failed_dir = os.path.join(spool, 'failed')
+        self.workers = workers
+        self.parts_per_upload = partsPerUpload
+        self.part_size = int(multipartMB * 2**20)
+        self.max_attempts = maxAttempts
+        self.retry_delay = retryDelay
+        self.max_retry_delay = maxRetryDelay
+        self.endpoint_url = endpointUrl
+        self.poll_interval = pollInterval
+        self.wakeup = Event()
+        self.process = None
+        os.makedirs(self.failed_dir, exist_ok=True)
+
+    def start(self):
+        '''
+        Starts the upload process, which first resumes the uploads left in
+        the spool.
+        '''
+        self.process = Process(target=self.run, name='uploader', daemon=True)
+        self.process.start()
+
+    def submit(self, upload:dict):
+        '''
+        Queues an upload by writing it to the spool and wakes the upload
+        process, restarting it if it died.
+        '''
+        job = dict(upload, attempts=0, nextAttempt=0)
+        name = f'{time.time():.6f}-{uuid.uuid4().hex}'
+        self.write_job(os.path.join(self.spool, name + JOB_EXTENSION), job)
+        logging.info(f'Queued upload of {upload["file"]} to s3')
+        if self.process is not None and not self.process.is_alive():
+            logging.error(f'Upload process exited with code {self.process.exitcode}, restarting it.')
+            self.start()
+        self.wakeup.set()
+
+    def write_job(self, path:str, job:dict):
+        pending = path + '.tmp'
+        with open(pending, 'w') as outfile:
+            json.dump(job, outfile)
+        os.replace(pending, path)
+
+    def pending_jobs(self):
+        '''
+        Returns the paths of the queued jobs, oldest first.
+        '''
+        return sorted(os.path.join(self.spool, name) for name in os.listdir(self.spool)
+                      if name.endswith(JOB_EXTENSION))
+
+    def create_client(self):
+        '''
+        Creates the S3 client shared by the upload threads, with a
+        connection for every part that can be in flight.
+        '''
+        config = Config(max_pool_connections=self.workers * self.parts_per_upload,
+                        retries={'max_attempts': 3, 'mode': 'standard'})
+        return boto3.session.Session().client('s3', endpoint_url=self.endpoint_url, config=config)
+
+    def run(self):
+        '''
+        Main loop of the upload process: starts the jobs that are due,
+        at most workers at a time, whenever a job is submitted or finishes
+        and at least every pollInterval seconds.
+        '''
+        client = self.create_client()
+        transfer = TransferConfig(multipart_threshold=self.part_size, multipart_chunksize=self.part_size,
+                                  max_concurrency=self.parts_per_upload)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='upload') as executor:
+            while True:
+                self.wakeup.wait(self.poll_interval)
+                self.wakeup.clear()
+                for path in [path for path, future in running.items() if future.done()]:
+                    running.pop(path)
+                self.start_due_jobs(executor, running, client, transfer)
+
+    def start_due_jobs(self, executor, running:dict, client, transfer):
+        now = time.time()
+        for path in self.pending_jobs():
+            if len(running) >= self.workers:
+                return
+            if path in running:
+                continue
+            try:
+                with open(path, 'r') as infile:
+                    job = json.load(infile)
+            except (OSError, ValueError):
+                continue
+            if job.get('nextAttempt', 0) > now:
+                continue
+            future = executor.submit(self.process_job, path, job, client, transfer)
+            future.add_done_callback(lambda _: self.wakeup.set())
+            running[path] = future
+
+    def process_job(self, path:str, job:dict, client, transfer):
+        '''
+        Uploads one job. On success the job is removed from the spool,
+        on failure it is rescheduled or given up.
+        '''
+        if not os.path.exists(job['path']):
+            self.give_up(path, job, f'{job["path"]} does not exist')
+            return
+        try:
+            self.upload(job, client, transfer)
+        except Exception as e:
+            job['attempts'] = job.get('attempts', 0) + 1
+            if job['attempts'] >= self.max_attempts:
+                self.give_up(path, job, repr(e))
+                return
+            # Full jitter keeps retries of a burst of failed uploads apart
+            delay = min(self.retry_delay * 2 ** (job['attempts'] - 1), self.max_retry_delay)
+            delay *= random.uniform(0.5, 1)
+            job['nextAttempt'] = time.time() + delay
+            self.write_job(path, job)
+            logging.warning(f'Upload of {job["file"]} failed ({e!r}), attempt {job["attempts"]} '
+                            + f'of {self.max_attempts}, retrying in {delay:.1f}s')
+            return
+        os.remove(path)
+
+    def upload(self, job:dict, client, transfer):
+        start = time.monotonic()
+        file, path = job['file'], job['path']
+        if job.get('gzip'):
             with open(path, 'rb') as inf:
-                with gzip.open(path + '.gz', 'wb') as outf:
-                    outf.writelines(inf)
+                with gzip.open(path + '.gz.tmp', 'wb') as outf:
+                    shutil.copyfileobj(inf, outf)
+            os.replace(path + '.gz.tmp', path + '.gz')
             file += '.gz'
             path += '.gz'
-        self.s3 = boto3.resource('s3')
-        self.bucket = bucket
-        self.key = f'{projectId}/Trials/{userId}/'
-        bucket = self.bucket
-        key = self.key + file
-        self.s3.meta.client.upload_file(path, bucket, key)
\ No newline at end of file
+        key = f'{job["projectId"]}/Trials/{job["userId"]}/{file}'
+        client.upload_file(path, job['bucket'], key, Config=transfer)
+        if job.get('gzip'):
+            os.remove(path)
+        logging.info(f'Uploaded {file} to s3 in {time.monotonic() - start:.2f}s')
+
+    def give_up(self, path:str, job:dict, reason:str):
+        '''
+        Moves a job that cannot be uploaded to the failed directory.
+        '''
+        os.replace(path, os.path.join(self.failed_dir, os.path.basename(path)))
+        logging.error(f'Giving up upload of {job["file"]} after {job.get("attempts", 0)} attempts: {reason}')
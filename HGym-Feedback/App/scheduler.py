@@ -0,0 +1,93 @@
+'''
+Frame pacing for Trial.run.
+
+Sleeping a fixed 1/framerate after each frame makes the real frame period
+work time + sleep time, so trials run slower than their framerate and the
+error changes with load. FrameScheduler instead targets absolute deadlines
+on the monotonic clock and only waits for what is left of the frame.
+
+What happens when a frame misses its deadline is set by 'framePolicy':
+    - catchup: following frames run without sleeping until the schedule is
+               caught up, so the average framerate stays exact. At most
+               'maxCatchUpFrames' frames are made up, beyond that the
+               schedule restarts from now.
+    - skip:    missed deadlines are dropped and the next frame is scheduled
+               on the next deadline still in the future, so frames stay
+               evenly spaced but the game runs slower while overloaded.
+'''
+import time
+
+POLICY_CATCHUP = 'catchup'
+POLICY_SKIP = 'skip'
+POLICIES = (POLICY_CATCHUP, POLICY_SKIP)
+
+# Frames starting later than this (seconds) count as late in the report,
+# below it is ordinary sleep overshoot
+LATE_THRESHOLD = 0.001
+
+
+class FrameScheduler():
+    def __init__(self, framerate:float, policy:str=POLICY_CATCHUP, maxCatchUpFrames:int=5):
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown framePolicy "{policy}", expected one of {POLICIES}')
+        self.policy = policy
+        self.max_catch_up = maxCatchUpFrames
+        self.period = 1 / framerate
+        self.next_deadline = time.monotonic() + self.period
+        self.frames = 0
+        self.late_frames = 0
+        self.missed_deadlines = 0
+        self.total_lateness = 0.0
+        self.max_lateness = 0.0
+
+    def set_framerate(self, framerate:float):
+        '''
+        Changes the frame period, the next deadline is counted from now.
+        '''
+        self.period = 1 / framerate
+        self.next_deadline = time.monotonic() + self.period
+
+    def time_until_deadline(self):
+        '''
+        Seconds left before the next frame is due, negative if it is late.
+        '''
+        return self.next_deadline - time.monotonic()
+
+    def tick(self):
+        '''
+        Marks the start of a frame: records its lateness against the current
+        deadline and moves the deadline forward according to the policy.
+        Returns the lateness in seconds.
+        '''
+        now = time.monotonic()
+        lateness = max(now - self.next_deadline, 0.0)
+        self.frames += 1
+        self.total_lateness += lateness
+        if lateness > LATE_THRESHOLD:
+            self.late_frames += 1
+            self.max_lateness = max(self.max_lateness, lateness)
+
+        behind = int(lateness / self.period)
+        if behind == 0:
+            self.next_deadline += self.period
+        elif self.policy == POLICY_SKIP:
+            self.missed_deadlines += behind
+            self.next_deadline += (behind + 1) * self.period
+        elif behind > self.max_catch_up:
+            self.missed_deadlines += behind
+            self.next_deadline = now + self.period
+        else:
+            self.next_deadline += self.period
+        return lateness
+
+    def report(self):
+        '''
+        Returns a dict summarizing how well the schedule was kept.
+        '''
+        return {
+            'policy': self.policy,
+            'frames': self.frames,
+            'lateFrames': self.late_frames,
+            'missedDeadlines': self.missed_deadlines,
+            'meanLatenessMs': round(1000 * self.total_lateness / max(self.frames, 1), 3),
+            'maxLatenessMs': round(1000 * self.max_lateness, 3)}
@@ -1,14 +1,21 @@
-import copy, numpy, json, shortuuid, time, base64, yaml, logging
-import pickle
-import _pickle as cPickle
-from PIL import Image
-from io import BytesIO
+import numpy, json, shortuuid, time, yaml, logging, random
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from agent import Agent, ReplayAgent
+from codec import DeltaEncoder, make_encoder
+from scheduler import FrameScheduler
+from framering import FrameRing
+from replaycache import ReplayCache
+from framestore import open_frame_store
+from recording import make_recorder, entry_size, observation_checksum, StepRecord
+from protocol import PROTOCOLS, PROTOCOL_BINARY, FLAG_DELTA, pack_frame, dump_json_frame
 import os
 
 
 
+@lru_cache(maxsize=None)
 def load_config():
+    # Cached so pre-forked workers (see workers.py) only read the file once
     logging.info('Loading Config in trial.py')
     with open('.trialConfig.yml', 'r') as infile:
         config = yaml.load(infile, Loader=yaml.FullLoader)
@@ -19,19 +26,43 @@ def get_trial_type(trial_type):
     return TRIAL_TYPE_MAPPING[trial_type]
 
 class Trial():
-    def __init__(self, pipe, trial_idx=0, global_trial_idx=0, data_trial_type='episode'):
+    def __init__(self, pipe, trial_idx=0, global_trial_idx=0, data_trial_type='episode', frame_ring=None, agent=None,
+                 autorun=True):
         self.config = load_config()
         self.pipe = pipe
+        self.agent = agent
+        self.frame_ring = FrameRing.attach(frame_ring) if frame_ring else None
         self.frameId = 0
         self.humanAction = 0
         self.episode = 0
         self.done = False
         self.play = False
         self.record = []
-        self.nextEntry = {}
+        self.record_size = 0
+        self.nextEntry = StepRecord()
         self.trialId = shortuuid.uuid()
         self.outfile = None
         self.framerate = self.config.get('startingFrameRate', 30)
+        self.frame_protocol = self.config.get('frameProtocol', 'json')
+        self.delivery_reports = 0
+        self.delivered_framerate_total = 0.0
+        self.min_delivered_framerate = None
+        self.dropped_frames = 0
+        self.pending_inputs = []
+        # None unless 'actionRecording' is configured, then its options
+        self.action_recording = self.config.get('actionRecording') or None
+        if self.action_recording is not None and not isinstance(self.action_recording, dict):
+            self.action_recording = {}
+        self.replay_spec = None
+        self.episode_steps = 0
+        self.encoder = make_encoder(self.config.get('frameCodec'))
+        self.pending_render = None
+        self.render_executor = None
+        self.scheduler = FrameScheduler(self.framerate,
+            self.config.get('framePolicy', 'catchup'), self.config.get('maxCatchUpFrames', 5))
+        if self.config.get('pipelineRender'):
+            # A single worker keeps frames encoded and sent in capture order
+            self.render_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='render')
         self.userId = None
         self.projectId = self.config.get('projectId')
         self.filename = None
@@ -41,6 +72,7 @@ class Trial():
         self.global_trial_idx = global_trial_idx
         if self.config.get('advancedActionSpace') is not None:
             self.active_keys = set([])
+            self.tapped_keys = set([])
             self.valid_keys = set(self.config.get('validKeys'))
             action_keys = self.config.get('advancedActionSpace')
             self.key_act_map = {frozenset(key_set): i for i, key_set in enumerate(action_keys)}
@@ -48,6 +80,7 @@ class Trial():
             self.action_space_type = 'advanced'
         elif self.config.get('continuousActionSpace') is not None:
             self.active_keys = set([])
+            self.tapped_keys = set([])
             self.valid_keys = set(self.config.get('validKeys'))
             self.key_act_map = {frozenset(k) if k is not None else None: v \
                 for k, v in self.config.get('continuousActionSpace')}
@@ -57,7 +90,8 @@ class Trial():
             self.action_space_type = 'simple'
 
         self.start()
-        self.run()
+        if autorun:
+            self.run()
 
     def start(self):
         '''
@@ -66,24 +100,63 @@ class Trial():
         to gym.make(). 
         By default this expects the openAI Gym Environment object to be
         returned. 
+        If the Trial was given an already started agent (e.g. by a warm
+        worker from workers.py) it is used as is.
         '''
+        if self.agent is not None:
+            return
         self.agent = Agent()
         self.agent.start(self.config.get('game'), self.config.get('frameskip', 1), self.config.get('maxEpisodeFrames', -1))
 
     def run(self):
         '''
         This is the main event controlling function for a Trial. 
-        It handles the render-step loop
+        It handles the render-step loop, paced by self.scheduler so that
+        frames start on absolute deadlines. How late each step started is
+        recorded with it as 'frameLateness' (seconds).
         '''
         while not self.done:
-            message = self.check_message()
-            if message:
-                self.handle_message(message)
-            if self.play:
+            self.run_frame()
+            self.record_lateness(self.wait_for_next_frame())
+
+    def run_frame(self):
+        '''
+        One iteration of the render-step loop: handles every waiting message,
+        then renders, sends and steps if the trial is playing. Called by
+        self.run, or by a SessionHost (workers.py) that runs several trials
+        in one process on their own schedules.
+        '''
+        self.handle_messages()
+        if self.play:
+            if self.render_executor:
+                self.submit_render()
+            else:
                 render = self.get_render()
                 self.send_render(render)
-                self.take_step()
-            time.sleep(1/self.framerate)
+            self.apply_inputs()
+            self.take_step()
+            self.release_tapped_keys()
+
+    def wait_for_next_frame(self):
+        '''
+        Spends the idle part of the frame blocked on the pipe instead of
+        sleeping, so input is handled as soon as it arrives and is always
+        applied to the very next step. Returns the lateness of the frame
+        that is now starting, see FrameScheduler.tick.
+        '''
+        remaining = self.scheduler.time_until_deadline()
+        while remaining > 0 and not self.done:
+            if self.pipe.poll(remaining):
+                self.handle_messages()
+            remaining = self.scheduler.time_until_deadline()
+        return self.scheduler.tick()
+
+    def record_lateness(self, lateness:float):
+        '''
+        Records how late the next step starts compared to its deadline.
+        '''
+        if self.play:
+            self.nextEntry['frameLateness'] = lateness
 
     def reset(self):
         '''
@@ -92,11 +165,17 @@ class Trial():
         episode, if the intention is to log only full trials then
         comment the 3 lines below contianing self.outfile and 
         self.create_file.
+        With dataFile: trial the whole trial is written to one file, which
+        stays open across episodes.
         '''
+        self.flush_render()
         if self.check_trial_done():
             self.end()
         else:
-            self.agent.reset()
+            self.reset_agent()
+            if self.outfile and self.config.get('dataFile') == 'trial':
+                self.episode += 1
+                return
             if self.outfile:
                 self.outfile.close()
                 if self.config.get('s3upload'):
@@ -106,10 +185,28 @@ class Trial():
                         'file': self.filename,
                         'path': self.path,
                         'bucket': self.config.get('bucket'),
-                        'gzip': True}})
+                        'gzip': not self.outfile.compressed}})
             self.create_file()
             self.episode += 1
 
+    def reset_agent(self):
+        '''
+        Resets the agent for a new episode. With 'actionRecording' the
+        episode is seeded and the seed recorded with its first step so the
+        episode can be regenerated from its actions, see regenerate.py.
+        '''
+        if self.action_recording is None:
+            self.agent.reset()
+            return
+        seed = random.randrange(2**31)
+        self.agent.reset(seed)
+        self.replay_spec = {
+            'game': self.config.get('game'),
+            'frameskip': self.config.get('frameskip', 1),
+            'maxEpisodeFrames': self.config.get('maxEpisodeFrames', -1),
+            'seed': seed}
+        self.episode_steps = 0
+
     def check_trial_done(self):
         '''
         Checks if the trial has been completed and can be quit. Add conditions
@@ -124,10 +221,56 @@ class Trial():
         whole trial memory in self.record, uncomment the call to self.save_record()
         to write the record to file before closing.
         '''
+        self.flush_render()
+        if self.render_executor:
+            self.render_executor.shutdown()
+        if self.config.get('dataFile') == 'trial':
+            self.save_record()
+        # The communicator stops reading the pipe at 'done', so the upload
+        # of the last file has to be sent before it
+        self.close_outfile()
         self.pipe.send('done')
         self.agent.close()
+        if self.frame_ring is not None:
+            self.frame_ring.close()
+        logging.info(f'Frame encoder report: {self.encoder.report()}')
+        logging.info(f'Frame schedule report: {self.scheduler.report()}')
+        if self.delivery_reports:
+            logging.info(f'Frame delivery report: {self.delivery_report()}')
+        self.play = False
+        self.done = True
+
+    def abort(self):
+        '''
+        Best-effort end() for a trial that raised, used by SessionHost
+        (workers.py) where the process outlives the trial. The frame being
+        encoded is abandoned and every cleanup step runs even if an earlier
+        one fails, so the participant still gets 'done', the data recorded so
+        far is uploaded and the environment and frame ring are released.
+        '''
+        self.pending_render = None
+        cleanups = []
+        if self.render_executor:
+            cleanups.append(lambda: self.render_executor.shutdown(wait=False))
         if self.config.get('dataFile') == 'trial':
-            self.save_record()
+            cleanups.append(self.save_record)
+        cleanups += [self.close_outfile, lambda: self.pipe.send('done')]
+        if self.agent is not None:
+            cleanups.append(self.agent.close)
+        if self.frame_ring is not None:
+            cleanups.append(self.frame_ring.close)
+        for cleanup in cleanups:
+            try:
+                cleanup()
+            except Exception:
+                logging.exception('Cleanup of a failed trial failed, continuing.')
+        self.play = False
+        self.done = True
+
+    def close_outfile(self):
+        '''
+        Closes the outfile, if any, and asks the communicator to upload it.
+        '''
         if self.outfile:
             self.outfile.close()
             self.pipe.send({'upload':{
@@ -136,10 +279,7 @@ class Trial():
                 'file': self.filename,
                 'path': self.path,
                 'bucket': self.config.get('bucket'),
-                'gzip': True}})
-        
-        self.play = False
-        self.done = True
+                'gzip': not self.outfile.compressed}})
 
     def check_message(self):
         '''
@@ -156,12 +296,33 @@ class Trial():
             return message
         return None
 
+    def handle_messages(self):
+        '''
+        Handles every message waiting in the pipe.
+        '''
+        message = self.check_message()
+        while message:
+            self.handle_message(message)
+            message = self.check_message()
+
     def handle_message(self, message:dict):
         '''
         Reads messages sent from websocket, handles commands as priority then 
         actions. Logs entire message in self.nextEntry
         '''
         logging.info('Message: ' + str(message))
+        if message.get('command') == 'keyframe':
+            # Sent by the communicator when a delta frame was lost, not by
+            # the participant, so it is not recorded with the step
+            self.encoder.request_keyframe()
+            return
+        if 'frameProtocol' in message:
+            self.set_frame_protocol(message['frameProtocol'])
+        if 'frameDelta' in message:
+            self.set_frame_delta(message['frameDelta'])
+        if 'deliveryReport' in message:
+            # Sent by the communicator, also recorded with the next step below
+            self.record_delivery(message['deliveryReport'])
         if not self.userId and 'userId' in message:
             self.userId = message['userId'] or f'user_{shortuuid.uuid()}'
             self.send_ui()
@@ -177,11 +338,63 @@ class Trial():
         elif 'KeyboardEvent' in message and self.action_space_type == 'advanced':
             self.handle_advanced_action(message['KeyboardEvent'])
 
+        # Input while paused is never applied to a step, so it is not kept
+        if self.play and ('KeyboardEvent' in message or 'action' in message):
+            self.pending_inputs.append({
+                'event': message.get('KeyboardEvent', message.get('action')),
+                'clientFrameId': message.get('frameId'),
+                'receivedFrameId': self.frameId,
+                'receivedTime': time.monotonic()})
+
         if 'action' in message:
             self.nextEntry['str_action'] = message['action']
             del message['action']
         self.update_entry(message)
 
+    def record_delivery(self, report:dict):
+        '''
+        Adds a delivery report from the communicator's FrameDelivery
+        (delivery.py) to the totals of delivery_report. Reports sent while
+        the trial is paused are left out, no frames are sent then.
+        '''
+        framerate = report.get('deliveredFrameRate')
+        if not self.play or framerate is None:
+            return
+        self.delivery_reports += 1
+        self.delivered_framerate_total += framerate
+        if self.min_delivered_framerate is None or framerate < self.min_delivered_framerate:
+            self.min_delivered_framerate = framerate
+        self.dropped_frames += len(report.get('droppedFrames', []))
+
+    def delivery_report(self):
+        '''
+        Returns a dict comparing the frame rate that actually reached the
+        participant with the trial's frame rate.
+        '''
+        return {
+            'frameRate': self.framerate,
+            'meanDeliveredFrameRate': round(self.delivered_framerate_total / max(self.delivery_reports, 1), 2),
+            'minDeliveredFrameRate': self.min_delivered_framerate,
+            'droppedFrames': self.dropped_frames}
+
+    def apply_inputs(self):
+        '''
+        Records the frameId shown for the step about to be taken, and the
+        input events received since the last step with the step they are
+        applied to as 'inputEvents', each with the frame shown when
+        it was received, the frame it is applied on, the frame the client
+        reported (if it sends one) and the delay before it was applied.
+        '''
+        self.nextEntry['frameId'] = self.frameId
+        if not self.pending_inputs:
+            return
+        now = time.monotonic()
+        for event in self.pending_inputs:
+            event['appliedFrameId'] = self.frameId
+            event['delayMs'] = round(1000 * (now - event.pop('receivedTime')), 3)
+        self.nextEntry['inputEvents'] = self.pending_inputs
+        self.pending_inputs = []
+
     def handle_command(self, command:str):
         '''
         Deals with allowable commands from user. To add other functionality
@@ -199,6 +412,32 @@ class Trial():
         elif command == 'requestUI':
             self.send_ui()
 
+    def set_frame_protocol(self, protocol:str):
+        '''
+        Selects how frames are sent to this connection, either the original
+        base64-in-json text messages or binary messages (see protocol.py).
+        Unknown protocols are ignored so old clients keep working.
+        '''
+        if isinstance(protocol, str) and protocol.strip().lower() in PROTOCOLS:
+            self.frame_protocol = protocol.strip().lower()
+
+    def set_frame_delta(self, enabled):
+        '''
+        Switches this connection to tile delta frames (see codec.DeltaEncoder)
+        when the client asks for them with {"frameDelta": true} and the
+        'frameDelta' entry is configured. Clients that never ask, like every
+        client written before delta frames, keep getting full frames.
+        '''
+        delta_config = self.config.get('frameDelta')
+        if enabled is not True or not delta_config or isinstance(self.encoder, DeltaEncoder):
+            return
+        # The render thread may still be encoding with the current encoder
+        self.flush_render()
+        if not isinstance(delta_config, dict):
+            delta_config = {}
+        logging.info(f'Client requested tile delta frames, using options {delta_config}')
+        self.encoder = DeltaEncoder(self.encoder, **delta_config)
+
     def handle_framerate_change(self, change:str):
         '''
         Changes the framerate in either increments of step, or to a requested 
@@ -222,6 +461,7 @@ class Trial():
                     self.framerate = requested
             except:
                 pass
+        self.scheduler.set_framerate(self.framerate)
 
 
     def handle_action(self, action:str):
@@ -243,51 +483,135 @@ class Trial():
         if 'KEYDOWN' in event:
             if self.valid_keys is None or event['KEYDOWN'][0] in self.valid_keys:
                 self.active_keys.add(event['KEYDOWN'][0])
+                self.tapped_keys.add(event['KEYDOWN'][0])
         if 'KEYUP' in event:
             if event['KEYUP'][0] in self.active_keys:
                 self.active_keys.remove(event['KEYUP'][0])
+        self.humanAction = self.get_key_action(self.active_keys | self.tapped_keys)
 
-        action_code = self.key_act_map.get(frozenset(self.active_keys))
+    def get_key_action(self, keys:set):
+        '''
+        Maps a set of pressed keys to an action, or the default action.
+        '''
+        action_code = self.key_act_map.get(frozenset(keys))
         if action_code is None:
             action_code = self.key_act_map.get(None, 0)
-        self.humanAction = action_code
+        return action_code
+
+    def release_tapped_keys(self):
+        '''
+        Key events are coalesced between steps, but a key pressed and
+        released before the next step must still act for that one step.
+        Keys pressed since the last step are kept in self.tapped_keys until
+        that step has been taken, then the action goes back to the keys
+        that are actually held.
+        '''
+        if self.action_space_type != 'advanced' or not self.tapped_keys:
+            return
+        self.tapped_keys.clear()
+        self.humanAction = self.get_key_action(self.active_keys)
    
     def update_entry(self, update_dict:dict):
         '''
-        Adds a generic dictionary to the self.nextEntry dictionary.
+        Adds a generic dictionary to the self.nextEntry StepRecord.
         '''
         self.nextEntry.update(update_dict)
 
     def get_render(self):
         '''
         Calls the Agent/Environment render function which must return a npArray.
-        Translates the npArray into a jpeg image and then base64 encodes the 
-        image for transmission in json message.
+        Encodes the npArray with the configured frame codec (jpeg by default),
+        or only its changed tiles if the client asked for delta frames.
+        The encoded bytes are returned as is, send_render takes care of
+        framing them for the connection's protocol.
+        '''
+        self.flush_render()
+        render, frameId = self.capture_render()
+        return self.encode_render(render, frameId)
+
+    def capture_render(self, copy:bool=False):
+        '''
+        Gets the npArray for the next frame from the Agent and assigns it the
+        next frameId. Frame ids are always assigned here, on the main loop,
+        so they stay paired with the step that follows even when encoding
+        happens on the render thread. Pass copy=True if the array will be
+        used after the environment steps again.
         '''
         render = self.agent.render()
+        if copy:
+            render = numpy.array(render)
+        self.frameId += 1
+        return render, self.frameId
+
+    def encode_render(self, render, frameId:int):
+        '''
+        Encodes a captured npArray into a render dict ready for send_render.
+        '''
         try:
-            img = Image.fromarray(render)
-            fp = BytesIO()
-            img.save(fp,'JPEG')
-            frame = base64.b64encode(fp.getvalue()).decode('utf-8')
-            fp.close()
+            render = self.encoder.encode_render(render)
         except: 
             raise TypeError("Render failed. Is env.render('rgb_array') being called\
                             With the correct arguement?")
-        self.frameId += 1
-        return {'frame': frame, 'frameId': self.frameId}
+        render['frameId'] = frameId
+        return render
+
+    def submit_render(self):
+        '''
+        Pipelined version of get_render + send_render used when pipelineRender
+        is set. The frame is captured now and encoded and sent on the render
+        thread while the main loop steps the environment. At most one frame
+        is in flight so frames are never reordered or queued up.
+        '''
+        self.flush_render()
+        render, frameId = self.capture_render(copy=True)
+        self.pending_render = self.render_executor.submit(
+            lambda: self.send_render(self.encode_render(render, frameId)))
+
+    def flush_render(self):
+        '''
+        Waits for the frame being encoded on the render thread, if any, to be
+        sent. Must be called before anything else is sent through the pipe so
+        messages keep their order. Re-raises errors from the render thread.
+        '''
+        if self.pending_render is not None:
+            pending, self.pending_render = self.pending_render, None
+            pending.result()
 
     def send_render(self, render:dict):
         '''
-        Attempts to send render message to websocket
+        Attempts to send render message to websocket, either as a binary
+        frame message or as base64 encoded json for older clients.
         '''
-        try: 
-            self.pipe.send(json.dumps(render))
-        except:
-            raise TypeError("Render Dictionary is not JSON serializable")
+        if self.frame_protocol == PROTOCOL_BINARY:
+            message = pack_frame(render)
+        else:
+            try: 
+                message = dump_json_frame(render)
+            except:
+                raise TypeError("Render Dictionary is not JSON serializable")
+        self.send_frame(message, render)
+
+    def send_frame(self, message, render:dict):
+        '''
+        Sends a frame message to the websocket, tagged with its frameId and
+        whether it is a delta frame so the communicator can drop frames for
+        slow connections (see delivery.py). With a shared-memory frame ring
+        the frame is written to the ring and only its slot number goes
+        through the pipe, frames too large for a slot use the pipe directly.
+        '''
+        frame = {'frameId': render['frameId'], 'delta': bool(render.get('flags', 0) & FLAG_DELTA)}
+        if self.frame_ring is not None:
+            seq = self.frame_ring.write(message)
+            if seq is not None:
+                frame['frameSlot'] = seq
+                self.pipe.send(frame)
+                return
+        frame['frame'] = message
+        self.pipe.send(frame)
 
     def send_ui(self):
         defaultUI = ['left','right','up','down','start','pause']
+        self.flush_render()
         try:
             ui_settings = self.config.get(self.trial_type + '_ui', defaultUI)
             self.pipe.send(json.dumps({'UI': ui_settings}))
@@ -302,14 +626,33 @@ class Trial():
         '''
         envState = self.agent.step(self.humanAction)
         self.update_entry(envState)
+        if self.action_recording is not None:
+            self.drop_observations()
         self.save_entry()
         if envState['done']:
             self.reset()
 
+    def drop_observations(self):
+        '''
+        Removes the observations from the next entry for 'actionRecording',
+        keeping a checksum of the observation every checksumInterval steps
+        and on the first and last step of the episode.
+        '''
+        if self.replay_spec is not None:
+            self.nextEntry['regenerate'] = self.replay_spec
+            self.replay_spec = None
+        self.episode_steps += 1
+        observation = self.nextEntry.pop('observation')
+        self.nextEntry.pop('raw_observation')
+        interval = self.action_recording.get('checksumInterval', 100)
+        if observation is not None and (self.episode_steps == 1 or self.episode_steps % interval == 0
+                                        or self.nextEntry.get('done')):
+            self.nextEntry['checksum'] = observation_checksum(observation)
+
     def save_entry(self):
         '''
-        Either saves step memory to self.record list or pickles the memory and
-        writes it to file, or both.
+        Either saves step memory to self.record list or writes it to file
+        through the recorder, or both.
         Note that observation and render objects can get large, an episode can
         have several thousand steps, holding all the steps for an episode in 
         memory can cause performance issues if the os needs to grow the heap.
@@ -317,26 +660,48 @@ class Trial():
         It is recommended to write each step to file and not maintain it in
         memory if the full observation is being saved.
         comment/uncomment the below lines as desired.
+        In trial mode self.record is written out as a segment whenever it
+        holds more than 'recordSegmentMB' of data, so memory use stays flat
+        however long the trial runs.
+        The recorders copy what they write, so in episode mode the same
+        StepRecord is cleared and reused. In trial mode, or when a
+        'recordWriter' thread does the writing, it is handed over, see
+        StepRecord.take, and a new one is started.
         '''
         if self.config.get('dataFile') == 'trial':
-            self.record.append(copy.deepcopy(self.nextEntry))
+            self.record.append(self.nextEntry.take())
+            self.record_size += entry_size(self.nextEntry)
+            self.nextEntry = StepRecord()
+            if self.record_size >= self.config.get('recordSegmentMB', 64) * 2**20:
+                self.save_record()
         else:
-            cPickle.dump(self.nextEntry, self.outfile)
-        self.nextEntry = {}
+            self.outfile.append(self.nextEntry)
+            if self.outfile.keeps_entries:
+                self.nextEntry = StepRecord()
+            else:
+                self.nextEntry.clear()
 
     def save_record(self):
         '''
         Saves the self.record object to file. Is only called if uncommented in
         self.end(). To record full trial records a line must also be uncommented
         in self.save_entry() and self.create_file()
+        Each call writes the steps recorded since the last one as a segment,
+        readers join the segments back into one record (see recording.py).
         '''
-        cPickle.dump(self.record, self.outfile)
+        if self.record:
+            self.outfile.append_record(self.record)
         self.record = []
+        self.record_size = 0
 
     def create_file(self):
         '''
         Creates a file to record records to. comment/uncomment as desired 
-        for episode or full-trial logging.
+        for episode or full-trial logging. The file format and compression
+        are set by the 'recordFormat' config entry, see recording.py. Data is
+        compressed as it is written, so compressed files are uploaded as is.
+        With 'recordWriter' set steps are written on a thread, closing the
+        file waits for it so uploads only start once the file is complete.
         '''
         if self.config.get('dataFile') == 'trial':
             filename = '{}_trial_{}_user_{}'.format(
@@ -345,31 +710,70 @@ class Trial():
             filename = '{}_trial_{}_episode_{}_user_{}'.format(
                 self.trial_type, self.trial_idx, self.episode, self.userId)
         path = 'Trials/' + filename
-        self.outfile = open(path, 'ab')
-        self.filename = filename
-        self.path = path
+        self.outfile = make_recorder(path, self.config.get('recordFormat'), self.config.get('recordWriter'))
+        self.filename = os.path.basename(self.outfile.path)
+        self.path = self.outfile.path
 
 TRIAL_DATA_DIR = 'ReplayData'
 
 class FeedbackTrial(Trial):
-    def __init__(self, pipe, trial_idx=0, global_trial_idx=0, data_file_type='episode'):
+    def __init__(self, pipe, trial_idx=0, global_trial_idx=0, data_file_type='episode', frame_ring=None, agent=None,
+                 autorun=True):
         self.human_feedback = 0
         self.data_file_type = data_file_type
-        super().__init__(pipe, trial_idx, global_trial_idx, data_file_type)
+        super().__init__(pipe, trial_idx, global_trial_idx, data_file_type, frame_ring, agent, autorun)
 
     def _get_trial_path(self, trial_idx):
         exp_names = os.listdir(TRIAL_DATA_DIR)
         if len(exp_names) != 1:
             raise ValueError(f'Expected 1 experiment, got {len(exp_names)}: {exp_names}')
         exp_name = exp_names[0]
-        return f'{TRIAL_DATA_DIR}/{exp_name}/replay_data_{trial_idx}.gz'
+        # Uncompressed (or columnar) replays can be memory-mapped, see ReplayAgent
+        path = f'{TRIAL_DATA_DIR}/{exp_name}/replay_data_{trial_idx}'
+        if os.path.exists(path):
+            return path
+        return path + '.gz'
 
     def start(self):
         trial_path = self._get_trial_path(self.trial_idx)
         logging.info(f'Starting feedback trial {self.trial_idx} with path {trial_path}')
+        replay_cache = None
+        cache_config = self.config.get('replayCache')
+        if cache_config:
+            if not isinstance(cache_config, dict):
+                cache_config = {}
+            replay_cache = ReplayCache(**cache_config)
+        frame_store = open_frame_store(trial_path, self.config.get('frameCodec'))
+        if frame_store is not None:
+            logging.info(f'Playing pre-encoded frames from {frame_store.path}')
 
         self.agent = ReplayAgent()
-        self.agent.start(trial_path, self.data_file_type) # self.config.get('game'))
+        self.agent.start(trial_path, self.data_file_type, self.config.get('replayReadAhead', 64),
+                         replay_cache, frame_store) # self.config.get('game'))
+
+    def reset_agent(self):
+        '''
+        Replays are not seeded, feedback trials never record observations.
+        '''
+        self.agent.reset()
+
+    def capture_render(self, copy:bool=False):
+        '''
+        Serves the replay's pre-encoded frame when it has a frame store, so
+        nothing is encoded. The store returns a new render dict every time,
+        encode_render only tags it with its frameId.
+        '''
+        render = self.agent.encoded_render()
+        if render is None:
+            return super().capture_render(copy)
+        self.frameId += 1
+        return render, self.frameId
+
+    def encode_render(self, render, frameId:int):
+        if isinstance(render, dict):
+            render['frameId'] = frameId
+            return render
+        return super().encode_render(render, frameId)
 
     def take_step(self):
         '''
@@ -0,0 +1,388 @@
+'''
+Pool of pre-forked Trial worker processes.
+
+Starting a Process per connection means every participant waits for the
+config to be read and the environment to be built before the first frame.
+With 'workerPoolSize' set in the trial config, the communicator keeps that
+many warm workers ready: each has already loaded the config and, for
+play_game trials, started its Agent. A new connection is handed to an idle
+worker and the pool is refilled in the background.
+
+A warm worker is a Process running warm_worker with the child end of its
+own Pipe. It waits for an assignment message on that pipe and then runs
+the Trial on the same pipe, so once assigned it behaves exactly like a
+Process started by the communicator.
+
+With 'sessionsPerWorker' above 1 the communicator instead uses SessionHost
+processes that each run up to that many Trials cooperatively, every Trial
+on its own frame schedule. All sessions of a host share one Pipe: messages
+are sent as (sessionId, message) tuples and routed on both ends, the host
+gives each Trial a SessionPipe so Trial code does not change.
+'''
+import asyncio, logging, shortuuid, threading
+from collections import deque
+from queue import Queue, Empty
+from multiprocessing import Process, Pipe
+from trial import load_config, get_trial_type
+from agent import Agent
+
+PLAY_TRIAL_TYPE = 'play_game'
+# How often a session host checks for Trials that finished building
+BUILD_POLL_SECONDS = 0.01
+
+
+def warm_worker(pipe):
+    '''
+    Target of a pre-forked worker process. Prepares everything that does
+    not depend on the participant, then blocks until the communicator
+    assigns a session with a message of the form:
+        {'assign': {'trialType', 'trialIdx', 'globalTrialIdx',
+                    'dataFile', 'frameRing'}}
+    '''
+    config = load_config()
+    agent = None
+    if PLAY_TRIAL_TYPE in config.get('trial_types', [PLAY_TRIAL_TYPE]):
+        agent = Agent()
+        agent.start(config.get('game'), config.get('frameskip', 1), config.get('maxEpisodeFrames', -1))
+
+    try:
+        message = pipe.recv()
+    except EOFError:
+        message = None
+    trial_type = message['assign']['trialType'] if message else None
+    if agent is not None and trial_type != PLAY_TRIAL_TYPE:
+        # Only play_game trials use the warm agent, the others start their own
+        agent.close()
+        agent = None
+    if message is None:
+        return
+    assignment = message['assign']
+    trial_cls = get_trial_type(trial_type)
+    trial_cls(pipe, assignment['trialIdx'], assignment['globalTrialIdx'], assignment['dataFile'],
+              frame_ring=assignment.get('frameRing'), agent=agent)
+
+
+class WorkerPool():
+    def __init__(self, size:int):
+        self.size = size
+        self.idle = deque()
+
+    def spawn(self):
+        '''
+        Forks a new warm worker and adds it to the idle workers.
+        '''
+        upPipe, downPipe = Pipe()
+        worker = Process(target=warm_worker, args=(downPipe,))
+        worker.start()
+        self.idle.append((worker, upPipe))
+
+    def fill(self):
+        '''
+        Tops the pool back up to its configured size.
+        '''
+        while len(self.idle) < self.size:
+            self.spawn()
+
+    def acquire(self, assignment:dict):
+        '''
+        Hands a session to an idle worker and returns (process, pipe) for it.
+        Workers that died while idle are discarded. If no worker is idle a
+        new one is started, which is no slower than not having a pool.
+        The pool is refilled once the event loop is free again.
+        '''
+        worker, pipe = None, None
+        while self.idle:
+            worker, pipe = self.idle.popleft()
+            if worker.is_alive():
+                break
+            logging.info(f'Discarding dead warm worker {worker.pid}')
+            pipe.close()
+            worker, pipe = None, None
+        if worker is None:
+            self.spawn()
+            worker, pipe = self.idle.popleft()
+        pipe.send({'assign': assignment})
+        asyncio.get_event_loop().call_soon(self.fill)
+        return worker, pipe
+
+    def close(self):
+        '''
+        Stops all idle workers.
+        '''
+        while self.idle:
+            worker, pipe = self.idle.popleft()
+            pipe.close()
+            worker.join(timeout=1)
+            if worker.is_alive():
+                worker.terminate()
+
+
+class SessionPipe():
+    '''
+    The Pipe interface a Trial expects, for one session of a SessionHost.
+    Incoming messages are queued by the host, outgoing messages are tagged
+    with the session id and sent through the host's pipe. The lock is
+    shared by all sessions of the host since render threads (pipelineRender)
+    may send at the same time.
+    '''
+    def __init__(self, pipe, session_id:str, lock:threading.Lock):
+        self.pipe = pipe
+        self.session_id = session_id
+        self.lock = lock
+        self.inbox = deque()
+
+    def poll(self, timeout=0):
+        return bool(self.inbox)
+
+    def recv(self):
+        return self.inbox.popleft()
+
+    def send(self, message):
+        with self.lock:
+            self.pipe.send((self.session_id, message))
+
+
+def session_host(pipe):
+    '''
+    Target of a SessionHost process. Runs every open session's frame when it
+    is due and otherwise waits on the pipe until the earliest deadline.
+    Control messages from the communicator are
+        {'open': {'sessionId', 'trialType', 'trialIdx', 'globalTrialIdx',
+                  'dataFile', 'frameRing'}}
+        {'close': sessionId}
+    and anything else is a (sessionId, message) tuple from a participant.
+    A new session's Trial, and with it its environment, is built on a thread
+    so the sessions already running keep their frame schedules. Messages for
+    it are queued meanwhile and it starts running once it is built.
+    '''
+    load_config()
+    sessions = {}
+    building = {}
+    closed_while_building = set()
+    built = Queue()
+    lock = threading.Lock()
+    while True:
+        add_built_sessions(built, building, closed_while_building, sessions)
+        timeout = None
+        if sessions:
+            timeout = max(min(trial.scheduler.time_until_deadline() for trial, _ in sessions.values()), 0)
+        if building:
+            # Wake up to start the sessions that finish building
+            timeout = BUILD_POLL_SECONDS if timeout is None else min(timeout, BUILD_POLL_SECONDS)
+        while pipe.poll(timeout):
+            timeout = 0
+            try:
+                message = pipe.recv()
+            except EOFError:
+                for thread, _ in building.values():
+                    thread.join()
+                closed_while_building.update(building)
+                add_built_sessions(built, building, closed_while_building, sessions)
+                for session_id, (trial, _) in sessions.items():
+                    end_session(session_id, trial)
+                return
+            if isinstance(message, tuple):
+                session_id, message = message
+                if session_id in sessions:
+                    sessions[session_id][1].inbox.append(message)
+                elif session_id in building:
+                    building[session_id][1].inbox.append(message)
+            elif 'open' in message:
+                assignment = message['open']
+                session_pipe = SessionPipe(pipe, assignment['sessionId'], lock)
+                thread = threading.Thread(target=lambda: built.put(
+                    (session_pipe.session_id, open_session(session_pipe, assignment))),
+                    name=f'open-{session_pipe.session_id}', daemon=True)
+                building[session_pipe.session_id] = (thread, session_pipe)
+                thread.start()
+            elif 'close' in message:
+                session_id = message['close']
+                if session_id in sessions:
+                    trial, _ = sessions.pop(session_id)
+                    end_session(session_id, trial)
+                elif session_id in building:
+                    closed_while_building.add(session_id)
+                else:
+                    # Already ended, the communicator still waits for its 'done'
+                    SessionPipe(pipe, session_id, lock).send('done')
+
+        for session_id, (trial, _) in list(sessions.items()):
+            if trial.scheduler.time_until_deadline() > 0:
+                continue
+            trial.record_lateness(trial.scheduler.tick())
+            try:
+                trial.run_frame()
+            except Exception:
+                # Without process isolation one failing trial must not take
+                # down the other sessions of this host
+                logging.exception(f'Session {session_id} failed, closing it.')
+                trial.abort()
+            if trial.done:
+                del sessions[session_id]
+
+def add_built_sessions(built:Queue, building:dict, closed_while_building:set, sessions:dict):
+    '''
+    Moves the sessions whose Trial finished building into sessions, ending
+    those that were closed in the meantime.
+    '''
+    while True:
+        try:
+            session_id, trial = built.get_nowait()
+        except Empty:
+            return
+        _, session_pipe = building.pop(session_id)
+        if trial is None:
+            closed_while_building.discard(session_id)
+        elif session_id in closed_while_building:
+            closed_while_building.discard(session_id)
+            end_session(session_id, trial)
+        else:
+            sessions[session_id] = (trial, session_pipe)
+
+def open_session(session_pipe:SessionPipe, assignment:dict):
+    '''
+    Builds the Trial of a new session on a SessionHost, called on the
+    session's build thread. Returns None if it could not be built, the
+    participant is then sent 'done' right away.
+    '''
+    try:
+        trial_cls = get_trial_type(assignment['trialType'])
+        return trial_cls(session_pipe, assignment['trialIdx'], assignment['globalTrialIdx'],
+                         assignment['dataFile'], frame_ring=assignment.get('frameRing'), autorun=False)
+    except Exception:
+        logging.exception(f'Session {session_pipe.session_id} could not be started.')
+        session_pipe.send('done')
+        return None
+
+def end_session(session_id:str, trial):
+    '''
+    Ends a session's Trial if it is still running, falling back to
+    Trial.abort if ending it raises.
+    '''
+    if trial.done:
+        return
+    try:
+        trial.end()
+    except Exception:
+        logging.exception(f'Session {session_id} failed while ending, closing it.')
+        trial.abort()
+
+
+class SessionHost():
+    '''
+    Communicator side of a session_host process. Routes the messages the
+    host sends to an asyncio.Queue per session, a None in the queue means
+    the host went away. A closed session's Trial still sends the upload of
+    its last file while ending, those are passed to on_upload until its
+    'done' arrives.
+    '''
+    def __init__(self, on_upload=None):
+        self.pipe, downPipe = Pipe()
+        self.process = Process(target=session_host, args=(downPipe,))
+        self.process.start()
+        self.queues = {}
+        self.closing = set()
+        self.on_upload = on_upload
+        asyncio.get_event_loop().add_reader(self.pipe.fileno(), self._route)
+
+    def _route(self):
+        while self.pipe.poll():
+            try:
+                session_id, message = self.pipe.recv()
+            except EOFError:
+                logging.info(f'Session host {self.process.pid} exited.')
+                asyncio.get_event_loop().remove_reader(self.pipe.fileno())
+                for queue in self.queues.values():
+                    queue.put_nowait(None)
+                self.queues = {}
+                self.closing = set()
+                return
+            queue = self.queues.get(session_id)
+            if queue is not None:
+                queue.put_nowait(message)
+            elif session_id in self.closing:
+                self._route_closing(session_id, message)
+
+    def _route_closing(self, session_id:str, message):
+        '''
+        Handles a message from a session that was closed while its Trial
+        was still running. Only uploads matter, frames are dropped.
+        '''
+        if message == 'done':
+            self.closing.discard(session_id)
+        elif isinstance(message, dict) and 'upload' in message:
+            if self.on_upload is not None:
+                self.on_upload(message)
+            else:
+                logging.error(f'Dropping upload of closed session {session_id}: {message}')
+
+    def alive(self):
+        return self.process.is_alive()
+
+    def open(self, assignment:dict):
+        '''
+        Starts a session on this host. Returns (pipe, queue): pipe.send passes
+        participant messages to the session and queue receives its output.
+        '''
+        session_id = shortuuid.uuid()
+        self.queues[session_id] = asyncio.Queue()
+        self.pipe.send({'open': dict(assignment, sessionId=session_id)})
+        return RoutedPipe(self.pipe, session_id), self.queues[session_id]
+
+    def close(self, session_id:str):
+        '''
+        Ends a session, the host stops its Trial if it is still running.
+        '''
+        if self.queues.pop(session_id, None) is not None and self.alive():
+            self.closing.add(session_id)
+            self.pipe.send({'close': session_id})
+
+
+class RoutedPipe():
+    '''
+    Sending end used by the communicator for one session of a SessionHost.
+    '''
+    def __init__(self, pipe, session_id:str):
+        self.pipe = pipe
+        self.session_id = session_id
+
+    def send(self, message):
+        self.pipe.send((self.session_id, message))
+
+
+class SessionHostPool():
+    '''
+    Places new sessions on the least busy SessionHost that still has room,
+    starting a new host when all are full. on_upload is called with the
+    upload messages of sessions that were closed before their Trial ended.
+    '''
+    def __init__(self, sessions_per_worker:int, on_upload=None):
+        self.sessions_per_worker = sessions_per_worker
+        self.on_upload = on_upload
+        self.hosts = []
+
+    def open(self, assignment:dict):
+        '''
+        Returns (host, pipe, queue) for a new session, see SessionHost.open.
+        '''
+        self.hosts = [host for host in self.hosts if host.alive()]
+        available = [host for host in self.hosts if len(host.queues) < self.sessions_per_worker]
+        if available:
+            host = min(available, key=lambda host: len(host.queues))
+        else:
+            host = SessionHost(self.on_upload)
+            self.hosts.append(host)
+        pipe, queue = host.open(assignment)
+        return host, pipe, queue
+
+    def close(self):
+        '''
+        Stops all hosts, ending any sessions still running on them.
+        '''
+        for host in self.hosts:
+            asyncio.get_event_loop().remove_reader(host.pipe.fileno())
+            host.pipe.close()
+            host.process.join(timeout=1)
+            if host.process.is_alive():
+                host.process.terminate()
+        self.hosts = []
@@ -224,7 +224,7 @@ def set_trial_config(trialConfig, projectConfig):
     logging.info('trialConfig.yml Created')
     return trialConfig
 
-def prepare_replay_files(project_config):
+def prepare_replay_files(project_config, trial_config=None):
     all_replay_dir = 'App/AllReplayData'
     replay_dir = 'App/ReplayData'
 
@@ -235,6 +235,7 @@ def prepare_replay_files(project_config):
     if os.path.exists(game_replay_dir):
         logging.info('Found existing replay data for this experiment. ' 
             + f'If you want to overwrite it, you must manually delete the folder: "{game_replay_dir}".')
+        build_frame_stores(game_replay_dir, trial_config)
         return
     elif os.path.exists(replay_dir):
         # Delete and recreate the replay_dir
@@ -250,6 +251,29 @@ def prepare_replay_files(project_config):
 
     # Copy replay data from source directory to experiment directory
     shutil.copytree(src_replay_dir, game_replay_dir)
+    build_frame_stores(game_replay_dir, trial_config)
+
+def build_frame_stores(game_replay_dir, trial_config=None):
+    '''
+    Encodes every replay once with the trial's frameCodec so feedback trials
+    can send the stored frames instead of encoding them for each participant
+    (see App/framestore.py). Frame stores that are up to date are kept.
+    '''
+    trial_config = trial_config or {}
+    if not trial_config.get('replayFrameStore', True):
+        return
+    sys.path.insert(0, 'App')
+    from framestore import build_frame_store, open_frame_store, EXTENSION
+
+    codec_config = trial_config.get('frameCodec')
+    for name in sorted(os.listdir(game_replay_dir)):
+        if not name.startswith('replay_data_') or name.endswith((EXTENSION, '.tmp')):
+            continue
+        replay_path = os.path.join(game_replay_dir, name)
+        if open_frame_store(replay_path, codec_config) is not None:
+            continue
+        logging.info(f'Encoding frames of {replay_path}...')
+        build_frame_store(replay_path, codec_config)
 
 def set_dotenv():
     logging.info('Copying .env to App...')
@@ -273,7 +297,7 @@ def main():
     projectConfig, trialConfig = load_config(args.config)
     print(trialConfig)
     trialConfig = set_trial_config(trialConfig, projectConfig)
-    prepare_replay_files(projectConfig)
+    prepare_replay_files(projectConfig, trialConfig)
     if projectConfig.get('useAWS'):
         check_dependencies()
         steps = check_steps(projectConfig)